@@ -1,29 +1,74 @@
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 import json
 import os
-from fastapi import Depends, FastAPI, Query, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, Query, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse
-from fastapi_sqlalchemy import DBSessionMiddleware, db
 from starlette.routing import Router
 
-from .sql_app import crud
-from .auth_bearer import JWTBearer
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .sql_app import async_crud
+from .auth_bearer import jwt_bearer
 from .model import UserLoginSchema, UserSchema
 
 from .routers import main, hue, wled
-from .consts import ErrorResponse, origins, version, SQLALCHEMY_DATABASE_URL
-from .auth_handler import check_password, decodeJWT, signJWT
-from .websocket import manager
+from .routers.main import LightHandler
+from .consts import ErrorResponse, origins, version
+from .auth_handler import PasswordHasherBusy, decodeJWT, needs_rehash, password_hasher, signJWT
+from .websocket import command_of, manager
+from .http_client import http_client
+from .cache import device_cache
+from .poller import poller
+from .rate_limit import RateLimitExceeded, retry_after_header
+from .eventstream import event_streams
+from .leader import LeaderElection, create_leader_lock
+from .serializer import JSONResponse
+from .context import RequestContext
+from .sql_app.database import AsyncReadSessionLocal, async_session
+
+
+async def start_background_jobs():
+    poller.start()
+    event_streams.start()
+
+
+async def stop_background_jobs():
+    await event_streams.stop()
+    await poller.stop()
+
+
+# only one worker polls devices and holds the bridge event streams
+leader = LeaderElection(create_leader_lock(), start_background_jobs, stop_background_jobs)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await manager.start()
+    await leader.start()
+    yield
+    await leader.stop()
+    await manager.stop()
+    await http_client.close()
+    password_hasher.close()
+
 
 app = FastAPI(
     title="Home API",
     description="API for controlling my home",
     version="0.1.0",
+    lifespan=lifespan,
+    default_response_class=JSONResponse,
 )
 
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded(request: Request, error: RateLimitExceeded):
+    return JSONResponse(status_code=429, content={"error": "Too many requests"}, headers=retry_after_header(error.retry_after))
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -31,7 +76,6 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.add_middleware(DBSessionMiddleware, db_url=SQLALCHEMY_DATABASE_URL)
 
 app.include_router(main, prefix="/api")
 app.include_router(hue, prefix="/api/hue")
@@ -40,13 +84,22 @@ app.include_router(wled, prefix="/api/wled")
 dist = os.path.join(os.path.dirname(__file__), "dist")
 
 
-def check_user(user: UserLoginSchema) -> bool:
-    db_user = crud.get_user_by_email(db.session, user.email)
+async def check_user(db: AsyncSession, user: UserLoginSchema) -> bool:
+    db_user = await async_crud.get_user_by_email(db, user.email)
     if db_user is None:
         return False
-    if check_password(user.password, db_user.hashed_password):
-        return True
-    return False
+    if not await password_hasher.check(user.password, db_user.hashed_password):
+        return False
+    if needs_rehash(db_user.hashed_password):
+        try:
+            await async_crud.update_user_hashed_password(db, user.email, await password_hasher.hash(user.password))
+        except PasswordHasherBusy:
+            pass
+    return True
+
+
+def busy_response() -> JSONResponse:
+    return JSONResponse(status_code=503, content={"error": "Too many requests, try again later"}, headers={"Retry-After": "1"})
 
 
 @dataclass
@@ -55,19 +108,27 @@ class AuthResponse():
     token_type: str
 
 
-@app.post("/api/auth/signup", responses={200: {"model": AuthResponse}, 409: {"model": ErrorResponse}})
-def signup(user: UserSchema):
-    if crud.get_user_by_email(db.session, user.email) is not None:
+@app.post("/api/auth/signup", responses={200: {"model": AuthResponse}, 409: {"model": ErrorResponse}, 503: {"model": ErrorResponse}})
+async def signup(user: UserSchema, db: AsyncSession = Depends(async_session)):
+    if await async_crud.get_user_by_email(db, user.email) is not None:
         return JSONResponse(status_code=409, content={"error": "Email already exists"})
-    if crud.get_user_by_username(db.session, user.username) is not None:
+    if await async_crud.get_user_by_username(db, user.username) is not None:
         return JSONResponse(status_code=409, content={"error": "Username already exists"})
-    crud.create_user(db.session, user)
+    try:
+        hashed_password = await password_hasher.hash(user.password)
+    except PasswordHasherBusy:
+        return busy_response()
+    await async_crud.create_user(db, user, hashed_password)
     return signJWT(user.email)
 
 
-@app.post("/api/auth/login", responses={200: {"model": AuthResponse}, 401: {"model": ErrorResponse}})
-def login(user: UserLoginSchema):
-    if check_user(user):
+@app.post("/api/auth/login", responses={200: {"model": AuthResponse}, 401: {"model": ErrorResponse}, 503: {"model": ErrorResponse}})
+async def login(user: UserLoginSchema, db: AsyncSession = Depends(async_session)):
+    try:
+        valid = await check_user(db, user)
+    except PasswordHasherBusy:
+        return busy_response()
+    if valid:
         return JSONResponse(status_code=200, content=signJWT(user.email))
     return JSONResponse(status_code=401, content={"error": "Invalid credentials"})
 
@@ -94,7 +155,7 @@ def get_status():
 
 
 @app.get("/api/auth/refresh", response_model=AuthResponse)
-def refresh(token: str = Depends(JWTBearer())):
+def refresh(token: str = Depends(jwt_bearer)):
     decoded = decodeJWT(token)
     if decoded is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
@@ -111,7 +172,7 @@ class UserResponse():
 
 
 @app.get("/api/auth/me", responses={200: {"model": UserResponse}, 401: {"model": ErrorResponse}})
-def me(token: str = Depends(JWTBearer())):
+def me(token: str = Depends(jwt_bearer)):
     decoded = decodeJWT(token)
     if decoded is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
@@ -133,15 +194,42 @@ if os.path.exists(dist):
         return RedirectResponse(url="/static")
 
 
+# @brief Sends a websocket client the snapshot of its user's lights and plugs
+# and switches it to patch messages.
+async def subscribe(websocket: WebSocket, token: str):
+    async with AsyncReadSessionLocal() as session:
+        context = RequestContext(token, session)
+        if await context.load() is None:
+            return
+        # fresh reads like the poller, not stale-while-revalidate cache entries
+        light_handler = LightHandler(context)
+        light_handler.hue.max_age = device_cache.ttl
+        light_handler.wled.max_age = device_cache.ttl
+        await manager.subscribe(websocket, light_handler.allDevices)
+
+
+@app.get("/api/metrics/websocket")
+def websocket_metrics(token: str = Depends(jwt_bearer)):
+    return JSONResponse(status_code=200, content=manager.metrics())
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
-    if not JWTBearer().verify_jwt(token):
+    if not await jwt_bearer.verify_jwt(token):
         await websocket.close()
         return
-    await manager.connect(websocket, token)
+    if not await manager.connect(websocket, token):
+        return
     try:
         while True:
-            await websocket.receive_text()
-            await websocket.send_text("pong")
+            text = await websocket.receive_text()
+            if command_of(text) in ("subscribe", "resync"):
+                await subscribe(websocket, token)
+                continue
+            await manager.send_personal_message("pong", websocket)
     except WebSocketDisconnect:
-        manager.disconnect(websocket, token)
+        pass
+    finally:
+        # also after errors, e.g. from a snapshot read or a socket the slow
+        # consumer policy already closed
+        manager.disconnect(websocket)
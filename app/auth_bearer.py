@@ -1,18 +1,18 @@
 from typing import Optional
 from fastapi import Request, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
-from .auth_handler import decodeJWT
-from .sql_app.database import SessionLocal
-from .sql_app import crud
+from .auth_handler import decodeJWT, verified_tokens
+from .sql_app.database import AsyncReadSessionLocal
+from .sql_app import async_crud
 
 
 class JWTBearer(HTTPBearer):
     __db__ = None
 
-    def __init__(self, db: Optional[Session] = None, auto_error: bool = True):
+    def __init__(self, db: Optional[AsyncSession] = None, auto_error: bool = True):
         super(JWTBearer, self).__init__(auto_error=auto_error)
         self.__db__ = db
 
@@ -22,7 +22,7 @@ class JWTBearer(HTTPBearer):
             if not credentials.scheme == "Bearer":
                 raise HTTPException(
                     status_code=403, detail="Invalid authentication scheme.")
-            if not self.verify_jwt(credentials.credentials):
+            if not await self.verify_jwt(credentials.credentials):
                 raise HTTPException(
                     status_code=403, detail="Invalid token or expired token.")
             return credentials.credentials
@@ -30,18 +30,30 @@ class JWTBearer(HTTPBearer):
             raise HTTPException(
                 status_code=403, detail="Invalid authorization code.")
 
-    def verify_jwt(self, jwtoken: str) -> bool:
+    async def verify_jwt(self, jwtoken: str) -> bool:
         isTokenValid: bool = False
 
+        if verified_tokens.get(jwtoken) is not None:
+            return True
+
         try:
             payload = decodeJWT(jwtoken)
         except:
             payload = None
         if payload:
             email = payload.get("email")
-            db = self.__db__ if self.__db__ is not None else SessionLocal()
-            if email is not None and crud.get_user_by_email(db, email) is not None:
+            if email is not None and await self.__user_exists__(email):
                 isTokenValid = True
-            if self.__db__ is None:
-                db.close()
+                verified_tokens.add(jwtoken, email, payload["expires"])
         return isTokenValid
+
+    async def __user_exists__(self, email: str) -> bool:
+        if self.__db__ is not None:
+            return await async_crud.get_user_by_email(self.__db__, email) is not None
+        async with AsyncReadSessionLocal() as db:
+            return await async_crud.get_user_by_email(db, email) is not None
+
+
+# shared instance, so FastAPI resolves the router and route level dependency
+# only once per request
+jwt_bearer = JWTBearer()
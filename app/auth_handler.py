@@ -1,9 +1,13 @@
+import asyncio
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 import jwt
 import bcrypt
-from typing import Dict
+from typing import Callable, Dict
 
-from .consts import JWT_SECRET, JWT_ALGORITHM
+from .consts import BCRYPT_MAX_QUEUE, BCRYPT_QUEUE_TIMEOUT, BCRYPT_ROUNDS, BCRYPT_WORKERS, JWT_SECRET, JWT_ALGORITHM, TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL
 
 TOKEN_VERSION = "1.0.0"
 
@@ -35,6 +39,45 @@ def decodeJWT(token: str) -> dict | None:
         return None
 
 
+# @brief LRU cache of tokens that were already verified against the database.
+#
+# Entries are keyed by the token hash and expire with the token, but at the
+# latest after `ttl` seconds, so changes made by other processes are picked
+# up eventually.
+class TokenCache:
+    def __init__(self, size: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.__tokens__: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def get(self, token: str) -> str | None:
+        key = sha256(token.encode()).hexdigest()
+        entry = self.__tokens__.get(key)
+        if entry is None:
+            return None
+        if entry[1] < time.time():
+            del self.__tokens__[key]
+            return None
+        self.__tokens__.move_to_end(key)
+        return entry[0]
+
+    def add(self, token: str, email: str, expires: float):
+        if self.size <= 0:
+            return
+        key = sha256(token.encode()).hexdigest()
+        self.__tokens__[key] = (email, min(expires, time.time() + self.ttl))
+        self.__tokens__.move_to_end(key)
+        while len(self.__tokens__) > self.size:
+            self.__tokens__.popitem(last=False)
+
+    def invalidate_email(self, email: str):
+        for key in [key for key, entry in self.__tokens__.items() if entry[0] == email]:
+            del self.__tokens__[key]
+
+
+verified_tokens = TokenCache()
+
+
 def check_for_latest_token_version(token: str) -> bool:
     try:
         decoded_token = decodeJWT(token)
@@ -46,8 +89,61 @@ def check_for_latest_token_version(token: str) -> bool:
 
 
 def hash_password(password: str) -> str:
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
 
 def check_password(password: str, hashed_password: str) -> bool:
     return bcrypt.checkpw(password.encode(), hashed_password.encode())
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    try:
+        return int(hashed_password.split("$")[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+# @brief Runs bcrypt on a small dedicated thread pool.
+#
+# At most `workers` hashes run at once. Further calls wait up to `timeout`
+# seconds for a free worker, and once `max_queue` calls are waiting new ones
+# are rejected right away with PasswordHasherBusy.
+class PasswordHasher:
+    def __init__(self, workers: int = BCRYPT_WORKERS, max_queue: int = BCRYPT_MAX_QUEUE, timeout: float = BCRYPT_QUEUE_TIMEOUT):
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.__pool__ = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="bcrypt")
+        self.__semaphore__ = asyncio.Semaphore(workers)
+        self.__waiting__ = 0
+
+    async def __run__(self, function: Callable, *args):
+        if self.__waiting__ >= self.max_queue:
+            raise PasswordHasherBusy()
+        self.__waiting__ += 1
+        try:
+            await asyncio.wait_for(self.__semaphore__.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise PasswordHasherBusy()
+        finally:
+            self.__waiting__ -= 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.__pool__, function, *args)
+        finally:
+            self.__semaphore__.release()
+
+    async def hash(self, password: str) -> str:
+        return await self.__run__(hash_password, password)
+
+    async def check(self, password: str, hashed_password: str) -> bool:
+        return await self.__run__(check_password, password, hashed_password)
+
+    def close(self):
+        self.__pool__.shutdown(wait=False)
+
+
+password_hasher = PasswordHasher()
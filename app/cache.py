@@ -0,0 +1,83 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Hashable
+
+from .consts import CACHE_STALE_TTL, CACHE_TTL
+
+
+# @brief In-process cache for device state read from bridges and WLED devices.
+#
+# Entries younger than `ttl` are served directly. Entries younger than
+# `ttl + stale_ttl` are served as well, but trigger a background refresh
+# (stale-while-revalidate). Callers passing `max_age` only accept entries up to
+# that age and wait for a fresh read otherwise. Concurrent misses for the same
+# key share a single request to the device. Pinned entries never expire; they
+# are kept current by a live source such as a bridge event stream.
+class DeviceCache:
+    def __init__(self, ttl: float = CACHE_TTL, stale_ttl: float = CACHE_STALE_TTL):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.__entries__: dict[Hashable, tuple[float, object]] = {}
+        self.__pending__: dict[Hashable, asyncio.Task] = {}
+        self.__pinned__: set[Hashable] = set()
+
+    def get(self, key: Hashable, max_age: float | None = None):
+        entry = self.__entries__.get(key)
+        if entry is None:
+            return None
+        if max_age is None:
+            max_age = self.ttl + self.stale_ttl
+        if key not in self.__pinned__ and time.monotonic() - entry[0] >= max_age:
+            return None
+        return entry[1]
+
+    def set(self, key: Hashable, value, pinned: bool = False):
+        self.__entries__[key] = (time.monotonic(), value)
+        if pinned:
+            self.__pinned__.add(key)
+
+    def is_pinned(self, key: Hashable) -> bool:
+        return key in self.__pinned__
+
+    def invalidate(self, *keys: Hashable):
+        for key in keys:
+            self.__entries__.pop(key, None)
+            self.__pending__.pop(key, None)
+            self.__pinned__.discard(key)
+
+    async def fetch(self, key: Hashable, fetcher: Callable[[], Awaitable], max_age: float | None = None):
+        entry = self.__entries__.get(key)
+        if entry is not None and key in self.__pinned__:
+            return entry[1]
+        if entry is not None and self.ttl > 0:
+            age = time.monotonic() - entry[0]
+            if age < (self.ttl if max_age is None else max_age):
+                return entry[1]
+            if max_age is None and age < self.ttl + self.stale_ttl:
+                self.__refresh__(key, fetcher)
+                return entry[1]
+        return await asyncio.shield(self.__refresh__(key, fetcher))
+
+    def __refresh__(self, key: Hashable, fetcher: Callable[[], Awaitable]) -> asyncio.Task:
+        task = self.__pending__.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.__load__(key, fetcher))
+            task.add_done_callback(
+                lambda done: done.cancelled() or done.exception())
+            self.__pending__[key] = task
+        return task
+
+    async def __load__(self, key: Hashable, fetcher: Callable[[], Awaitable]):
+        task = asyncio.current_task()
+        try:
+            value = await fetcher()
+            # a write invalidated the key while this request was in flight
+            if value is not None and self.__pending__.get(key) is task:
+                self.set(key, value)
+            return value
+        finally:
+            if self.__pending__.get(key) is task:
+                del self.__pending__[key]
+
+
+device_cache = DeviceCache()
@@ -0,0 +1,78 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Hashable
+
+from .consts import LIGHT_WRITE_INTERVAL, LightState
+
+
+class PendingWrite:
+    def __init__(self, state: LightState, send: Callable[[LightState], Awaitable]):
+        self.state = state
+        self.send = send
+        self.futures: list[asyncio.Future] = []
+
+
+# @brief Coalesces rapid state writes to the same light.
+#
+# A write is sent at most every `interval` seconds per light. Writes arriving
+# in between are merged into one pending state (newer fields win) and all of
+# their callers get the result of the write that was finally sent.
+class WriteCoalescer:
+    def __init__(self, interval: float = LIGHT_WRITE_INTERVAL):
+        self.interval = interval
+        self.__pending__: dict[Hashable, PendingWrite] = {}
+        self.__sending__: dict[Hashable, asyncio.Task] = {}
+        self.__last__: dict[Hashable, float] = {}
+
+    async def submit(self, key: Hashable, state: LightState, send: Callable[[LightState], Awaitable]):
+        if self.interval <= 0:
+            return await send(state)
+
+        pending = self.__pending__.get(key)
+        if pending is None:
+            pending = PendingWrite(state, send)
+            self.__pending__[key] = pending
+            previous = self.__sending__.get(key)
+            self.__sending__[key] = asyncio.create_task(
+                self.__flush__(key, previous))
+        else:
+            pending.state = type(state)(**{
+                **pending.state.dict(exclude_none=True),
+                **state.dict(exclude_none=True),
+            })
+            pending.send = send
+
+        future = asyncio.get_running_loop().create_future()
+        pending.futures.append(future)
+        return await future
+
+    async def __flush__(self, key: Hashable, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.wait([previous])
+        wait = self.__last__.get(key, 0) + self.interval - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        pending = self.__pending__.pop(key)
+        self.__last__[key] = time.monotonic()
+        try:
+            result = await pending.send(pending.state)
+            for future in pending.futures:
+                if not future.done():
+                    future.set_result(result)
+        except Exception as error:
+            for future in pending.futures:
+                if not future.done():
+                    future.set_exception(error)
+        finally:
+            # the light stays throttled until the interval is over, after that
+            # nothing about it needs to be kept
+            wait = self.__last__[key] + self.interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if self.__sending__.get(key) is asyncio.current_task():
+                del self.__sending__[key]
+                del self.__last__[key]
+
+
+light_coalescer = WriteCoalescer()
@@ -0,0 +1,172 @@
+import numpy as np
+
+# colour gamut C of current Hue bulbs, used when a light doesn't report one
+DEFAULT_GAMUT = ((0.6915, 0.3083), (0.17, 0.7), (0.1532, 0.0475))
+
+# wide gamut D65 conversion from CIE XYZ to linear RGB
+XYZ_TO_RGB = np.array([
+    [1.656492, -0.354851, -0.255038],
+    [-0.707196, 1.655397, 0.036152],
+    [0.051713, -0.121364, 1.011530],
+])
+
+
+def to_rgb8(rgb: np.ndarray) -> np.ndarray:
+    return np.rint(np.clip(rgb, 0, 1) * 255).astype(np.int64)
+
+
+# @brief Converts hue/saturation/value in the range 0-1 to rgb in the range 0-1.
+def hsv_to_rgb(hue: np.ndarray, saturation: np.ndarray, value: np.ndarray) -> np.ndarray:
+    hue = np.asarray(hue, dtype=np.float64) % 1.0 * 6
+    saturation = np.asarray(saturation, dtype=np.float64)
+    value = np.asarray(value, dtype=np.float64)
+    sector = np.floor(hue).astype(np.int64) % 6
+    fraction = hue - np.floor(hue)
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * fraction)
+    t = value * (1 - saturation * (1 - fraction))
+    red = np.choose(sector, [value, q, p, p, t, value])
+    green = np.choose(sector, [t, value, value, q, p, p])
+    blue = np.choose(sector, [p, p, t, value, value, q])
+    return np.stack([red, green, blue], axis=-1)
+
+
+# @brief Converts rgb in the range 0-1 to hue/saturation/value in the range 0-1.
+def rgb_to_hsv(rgb: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    rgb = np.asarray(rgb, dtype=np.float64)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    maximum = rgb.max(axis=-1)
+    delta = maximum - rgb.min(axis=-1)
+    safe_delta = np.where(delta == 0, 1, delta)
+    hue = np.select(
+        [maximum == red, maximum == green],
+        [(green - blue) / safe_delta, 2 + (blue - red) / safe_delta],
+        4 + (red - green) / safe_delta,
+    )
+    hue = np.where(delta == 0, 0, hue / 6 % 1.0)
+    saturation = np.where(maximum == 0, 0, delta /
+                          np.where(maximum == 0, 1, maximum))
+    return hue, saturation, maximum
+
+
+# @brief Converts Hue bridge hue (0-65535), sat and bri (0-255) to rgb (0-255).
+def hsb_to_rgb(hue: np.ndarray, sat: np.ndarray, bri: np.ndarray) -> np.ndarray:
+    return to_rgb8(hsv_to_rgb(
+        np.asarray(hue, dtype=np.float64) / 65535,
+        np.asarray(sat, dtype=np.float64) / 255,
+        np.asarray(bri, dtype=np.float64) / 255,
+    ))
+
+
+# @brief Converts rgb (0-255) to Hue bridge hue (0-65535), sat and bri (0-255).
+def rgb_to_hsb(rgb: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    hue, saturation, value = rgb_to_hsv(np.asarray(rgb, dtype=np.float64) / 255)
+    return (np.rint(hue * 65535).astype(np.int64),
+            np.rint(saturation * 255).astype(np.int64),
+            np.rint(value * 255).astype(np.int64))
+
+
+def __closest_on_segment__(points: np.ndarray, start: np.ndarray, end: np.ndarray) -> np.ndarray:
+    direction = end - start
+    length = np.maximum((direction ** 2).sum(axis=-1, keepdims=True), 1e-12)
+    position = ((points - start) * direction).sum(axis=-1, keepdims=True) / length
+    return start + np.clip(position, 0, 1) * direction
+
+
+# @brief Moves xy points (n, 2) that lie outside their gamut triangle (n, 3, 2)
+# to the closest point on the triangle.
+def clamp_to_gamut(xy: np.ndarray, gamut: np.ndarray) -> np.ndarray:
+    xy = np.asarray(xy, dtype=np.float64)
+    gamut = np.broadcast_to(np.asarray(gamut, dtype=np.float64),
+                            xy.shape[:-1] + (3, 2))
+    red, green, blue = gamut[..., 0, :], gamut[..., 1, :], gamut[..., 2, :]
+
+    def cross(origin, a, b):
+        return (a[..., 0] - origin[..., 0]) * (b[..., 1] - origin[..., 1]) - \
+            (a[..., 1] - origin[..., 1]) * (b[..., 0] - origin[..., 0])
+
+    sides = np.stack([cross(red, green, xy), cross(
+        green, blue, xy), cross(blue, red, xy)], axis=-1)
+    inside = np.all(sides >= 0, axis=-1) | np.all(sides <= 0, axis=-1)
+
+    candidates = np.stack([
+        __closest_on_segment__(xy, red, green),
+        __closest_on_segment__(xy, green, blue),
+        __closest_on_segment__(xy, blue, red),
+    ], axis=-2)
+    distances = ((candidates - xy[..., None, :]) ** 2).sum(axis=-1)
+    closest = np.take_along_axis(
+        candidates, distances.argmin(axis=-1)[..., None, None], axis=-2)[..., 0, :]
+    return np.where(inside[..., None], xy, closest)
+
+
+# @brief Converts CIE xy (n, 2) with Hue bri (0-255) to rgb (0-255).
+def xy_to_rgb(xy: np.ndarray, bri: np.ndarray, gamut: np.ndarray = DEFAULT_GAMUT) -> np.ndarray:
+    xy = clamp_to_gamut(xy, gamut)
+    x, y = xy[..., 0], np.maximum(xy[..., 1], 1e-6)
+    luminance = np.asarray(bri, dtype=np.float64) / 255
+    xyz = np.stack([luminance / y * x, luminance,
+                   luminance / y * (1 - x - y)], axis=-1)
+    rgb = xyz @ XYZ_TO_RGB.T
+    rgb = np.where(rgb <= 0.0031308, 12.92 * rgb,
+                   1.055 * np.power(np.maximum(rgb, 0), 1 / 2.4) - 0.055)
+    rgb = np.clip(rgb, 0, None)
+    maximum = rgb.max(axis=-1, keepdims=True)
+    rgb = np.where(maximum > 1, rgb / np.where(maximum == 0, 1, maximum), rgb)
+    return to_rgb8(rgb)
+
+
+# @brief Converts a colour temperature in mired with Hue bri (0-255) to rgb (0-255).
+def ct_to_rgb(mired: np.ndarray, bri: np.ndarray) -> np.ndarray:
+    kelvin = 1e6 / np.maximum(np.asarray(mired, dtype=np.float64), 1)
+    temperature = np.clip(kelvin, 1000, 40000) / 100
+    warm = temperature <= 66
+    red = np.where(warm, 255, 329.698727446 *
+                   np.power(np.maximum(temperature - 60, 1e-6), -0.1332047592))
+    green = np.where(warm, 99.4708025861 * np.log(temperature) - 161.1195681661,
+                     288.1221695283 * np.power(np.maximum(temperature - 60, 1e-6), -0.0755148492))
+    blue = np.select([temperature >= 66, temperature <= 19],
+                     [255, 0], 138.5177312231 * np.log(np.maximum(temperature - 10, 1e-6)) - 305.0447927307)
+    rgb = np.clip(np.stack([red, green, blue], axis=-1), 0, 255) / 255
+    return to_rgb8(rgb * (np.asarray(bri, dtype=np.float64) / 255)[..., None])
+
+
+# @brief Computes the rgb colour (0-255) of many Hue v1 light states at once,
+# honouring each light's colormode (hs, xy or ct).
+def light_colors(states: list[dict], gamuts: list | None = None) -> np.ndarray:
+    count = len(states)
+    if count == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    bri = np.array([state.get("bri", 255) for state in states], dtype=np.float64)
+    modes = np.array([state.get("colormode") for state in states], dtype=object)
+    hue = np.array([state.get("hue", 0) for state in states], dtype=np.float64)
+    sat = np.array([state.get("sat", 0) for state in states], dtype=np.float64)
+    xy = np.array([state.get("xy") or (0.3127, 0.329)
+                  for state in states], dtype=np.float64)
+    ct = np.array([state.get("ct") or 366 for state in states], dtype=np.float64)
+    gamut = np.array([gamut or DEFAULT_GAMUT for gamut in (gamuts or [None] * count)],
+                     dtype=np.float64)
+
+    colors = hsb_to_rgb(hue, sat, bri)
+    is_xy = modes == "xy"
+    if is_xy.any():
+        colors[is_xy] = xy_to_rgb(xy[is_xy], bri[is_xy], gamut[is_xy])
+    is_ct = modes == "ct"
+    if is_ct.any():
+        colors[is_ct] = ct_to_rgb(ct[is_ct], bri[is_ct])
+    return colors
+
+
+# @brief Reduces WLED segment colours (n, 3 or 4) to rgb (0-255), mixing the
+# white channel of rgbw strips into all three channels.
+def segment_colors(colors: list) -> np.ndarray:
+    if len(colors) == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    width = max(len(color) for color in colors)
+    array = np.zeros((len(colors), max(width, 3)), dtype=np.int64)
+    for index, color in enumerate(colors):
+        array[index, :len(color)] = color
+    rgb = array[:, :3]
+    if array.shape[1] > 3:
+        rgb = rgb + array[:, 3:4]
+    return np.clip(rgb, 0, 255)
@@ -1,10 +1,11 @@
 from dataclasses import dataclass
-from json import dumps, loads
 from typing import Optional
 from pydantic import BaseModel
 from os import path, environ
 from dotenv import load_dotenv
 
+from .serializer import dumps, loads, to_primitive
+
 DOTENV_FILE = path.join(path.dirname(__file__), "..", ".env")
 
 load_dotenv(DOTENV_FILE)
@@ -12,38 +13,100 @@ load_dotenv(DOTENV_FILE)
 config = environ.get
 
 port = int(config("port", "8000"))
+WORKERS = int(config("WORKERS", "1"))
 
 version = str(config("version", "1.0.0"))
 
 JWT_SECRET = str(config("secret"))
 JWT_ALGORITHM = str(config("algorithm"))
 
+TOKEN_CACHE_SIZE = int(config("TOKEN_CACHE_SIZE", "1024"))
+TOKEN_CACHE_TTL = float(config("TOKEN_CACHE_TTL", "300"))
+
+BCRYPT_ROUNDS = int(config("BCRYPT_ROUNDS", "12"))
+BCRYPT_WORKERS = int(config("BCRYPT_WORKERS", "2"))
+BCRYPT_MAX_QUEUE = int(config("BCRYPT_MAX_QUEUE", "32"))
+BCRYPT_QUEUE_TIMEOUT = float(config("BCRYPT_QUEUE_TIMEOUT", "5"))
+
 SQLALCHEMY_DATABASE_URL = str(
     config("DATABASE_URL", "sqlite:///./home_api.db"))
+DATABASE_MIGRATE = str(config("DATABASE_MIGRATE", "false")).lower() == "true"
+DATABASE_READ_URL = str(config("DATABASE_READ_URL", ""))
+DATABASE_POOL_SIZE = int(config("DATABASE_POOL_SIZE", "5"))
+DATABASE_MAX_OVERFLOW = int(config("DATABASE_MAX_OVERFLOW", "10"))
+DATABASE_POOL_TIMEOUT = float(config("DATABASE_POOL_TIMEOUT", "30"))
+DATABASE_POOL_RECYCLE = int(config("DATABASE_POOL_RECYCLE", "1800"))
+DATABASE_POOL_PRE_PING = str(
+    config("DATABASE_POOL_PRE_PING", "true")).lower() == "true"
+SQLITE_JOURNAL_MODE = str(config("SQLITE_JOURNAL_MODE", "wal"))
+SQLITE_SYNCHRONOUS = str(config("SQLITE_SYNCHRONOUS", "normal"))
+SQLITE_MMAP_SIZE = int(config("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT = float(config("SQLITE_BUSY_TIMEOUT", "5"))
+
+HTTP_TIMEOUT = float(config("HTTP_TIMEOUT", "5"))
+HTTP_CONNECT_TIMEOUT = float(config("HTTP_CONNECT_TIMEOUT", "2"))
+HTTP_MAX_CONNECTIONS = int(config("HTTP_MAX_CONNECTIONS", "10"))
+HTTP_MAX_KEEPALIVE = int(config("HTTP_MAX_KEEPALIVE", "5"))
+HTTP_KEEPALIVE_EXPIRY = float(config("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+USER_RATE_LIMIT = float(config("USER_RATE_LIMIT", "20"))
+USER_RATE_BURST = float(config("USER_RATE_BURST", "40"))
+DEVICE_RATE_LIMIT = float(config("DEVICE_RATE_LIMIT", "10"))
+DEVICE_RATE_BURST = float(config("DEVICE_RATE_BURST", "10"))
+DEVICE_RATE_MAX_WAIT = float(config("DEVICE_RATE_MAX_WAIT", "1"))
+
+HUE_BRIDGE_TIMEOUT = float(config("HUE_BRIDGE_TIMEOUT", "3"))
+HUE_RECONCILE_DELAY = float(config("HUE_RECONCILE_DELAY", "0"))
+
+WLED_TIMEOUT = float(config("WLED_TIMEOUT", "2"))
+WLED_CONCURRENCY = int(config("WLED_CONCURRENCY", "8"))
+
+CACHE_TTL = float(config("CACHE_TTL", "1"))
+CACHE_STALE_TTL = float(config("CACHE_STALE_TTL", "10"))
+
+LIGHT_WRITE_INTERVAL = float(config("LIGHT_WRITE_INTERVAL", "0.1"))
+
+POLL_INTERVAL = float(config("POLL_INTERVAL", "5"))
+
+WS_SEND_QUEUE = int(config("WS_SEND_QUEUE", "64"))
+WS_SEND_TIMEOUT = float(config("WS_SEND_TIMEOUT", "5"))
+# drop_oldest, coalesce or disconnect
+WS_SLOW_CONSUMER = str(config("WS_SLOW_CONSUMER", "drop_oldest")).lower()
+
+# runtime files of the workers are kept next to a SQLite database, in the
+# working directory otherwise
+SQLITE_FILE = SQLALCHEMY_DATABASE_URL.split("?")[0][len("sqlite:///"):] \
+    if SQLALCHEMY_DATABASE_URL.startswith("sqlite:///") else ""
+DATA_DIR = str(config("DATA_DIR", path.dirname(SQLITE_FILE) or "."))
+
+# memory://, unix:///path/to/socket or redis://host:port/db
+PUBSUB_URL = str(config("PUBSUB_URL", "memory://"))
+PUBSUB_CHANNEL = str(config("PUBSUB_CHANNEL", "homeapi"))
+# unix socket the workers use when PUBSUB_URL is left at memory://
+PUBSUB_SOCKET = str(config("PUBSUB_SOCKET", path.join(
+    DATA_DIR, "home_api.pubsub.sock")))
+
+LEADER_LOCK_FILE = str(config("LEADER_LOCK_FILE", path.join(
+    DATA_DIR, "home_api.leader.lock")))
+LEADER_INTERVAL = float(config("LEADER_INTERVAL", "5"))
+LEADER_TTL = float(config("LEADER_TTL", "15"))
+
+HUE_EVENTSTREAM = str(config("HUE_EVENTSTREAM", "false")).lower() == "true"
+HUE_EVENTSTREAM_SCHEME = str(config("HUE_EVENTSTREAM_SCHEME", "https"))
+HUE_EVENTSTREAM_SYNC_INTERVAL = float(
+    config("HUE_EVENTSTREAM_SYNC_INTERVAL", "30"))
 
 
 class BaseClass(BaseModel):
+    # @brief Plain dict copy of the model without None fields, the model
+    # itself is left untouched.
     def to_dict(self, recursive: bool = True) -> dict:
-        keys_to_remove = []
         if recursive:
-            for key in self.__dict__:
-                if isinstance(self.__dict__[key], BaseClass):
-                    self.__dict__[key] = self.__dict__[key].to_dict(recursive)
-                elif isinstance(self.__dict__[key], list):
-                    for i in range(len(self.__dict__[key])):
-                        if isinstance(self.__dict__[key][i], BaseClass):
-                            self.__dict__[key][i] = self.__dict__[
-                                key][i].to_dict(recursive)
-                elif self.__dict__[key] is None:
-                    keys_to_remove.append(key)
-
-        for key in keys_to_remove:
-            del self.__dict__[key]
-
-        return self.__dict__
+            return to_primitive(self)
+        return {key: value for key, value in self.__dict__.items() if value is not None}
 
     def to_json(self) -> str:
-        return dumps(self.__dict__)
+        return dumps(self).decode()
 
     def load_from_dict(self, __dict__: dict):
         self.__dict__.update(__dict__)
@@ -109,7 +172,7 @@ class WledSeg(BaseClass):
     start: int
     stop: int
     len: int
-    col: list[tuple[int, int, int]]
+    col: list[list[int]]
     fx: int
     sx: int
     ix: int
@@ -240,6 +303,14 @@ class HuePlugResponse(BaseClass):
     productid: Optional[str]
 
 
+class HueGroupResponse(BaseClass):
+    name: str
+    lights: list[str]
+    type: str
+    action: dict
+    state: Optional[dict]
+
+
 class PlugState(LightState):
     on: bool
 
@@ -276,6 +347,58 @@ class Plug(BaseClass):
     productid: Optional[str]
 
 
+# @brief Normalized light as kept by the poller and pushed over the websocket.
+#
+# A frozen, slotted record instead of a pydantic model, so thousands of them
+# stay cheap to build, compare and keep around. `Light` describes the same
+# shape at the API boundary.
+@dataclass(frozen=True, slots=True)
+class LightRecord():
+    id: str
+    name: str
+    on: bool
+    brightness: float
+    color: tuple[tuple[int, int, int], ...]
+    reachable: bool
+    type: str
+    model: str
+    manufacturer: str
+    uniqueid: str
+    swversion: str
+    productid: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return to_primitive(self)
+
+
+# @brief Normalized plug, see LightRecord.
+@dataclass(frozen=True, slots=True)
+class PlugRecord():
+    id: str
+    name: str
+    on: bool
+    reachable: bool
+    type: str
+    model: str
+    manufacturer: str
+    uniqueid: str
+    swversion: str
+    productid: Optional[str] = None
+
+    def to_dict(self) -> dict:
+        return to_primitive(self)
+
+
+class LightStateUpdate(BaseClass):
+    id: str
+    state: LightState
+
+
+class LightsStateResponse(BaseClass):
+    lights: list[Light]
+    errors: dict[str, str]
+
+
 class WebSocketMessage(BaseClass):
     type: str
     data: dict
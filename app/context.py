@@ -0,0 +1,60 @@
+from typing import AsyncIterator
+from fastapi import Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .auth_bearer import jwt_bearer
+from .auth_handler import decodeJWT
+from .sql_app import async_crud, models
+from .sql_app.database import AsyncReadSessionLocal, AsyncSessionLocal
+
+
+# @brief Everything a request needs to know about its user.
+#
+# The user is loaded by `load` together with the settings, Hue bridges and
+# WLED items in a single query, and then shared by every handler of the
+# request. Handlers write through `db`.
+class RequestContext:
+    token: str
+    db: AsyncSession
+
+    def __init__(self, token: str, db: AsyncSession, user: models.User | None = None):
+        self.token = token
+        self.db = db
+        self.__user__ = user
+        self.__loaded__ = user is not None
+
+    async def load(self, db: AsyncSession | None = None) -> models.User | None:
+        if not self.__loaded__:
+            email = (decodeJWT(self.token) or {}).get("email")
+            self.__user__ = await async_crud.get_user_with_settings_by_email(
+                db if db is not None else self.db, email) if email else None
+            self.__loaded__ = True
+        return self.__user__
+
+    @property
+    def user(self) -> models.User | None:
+        return self.__user__
+
+    @property
+    def settings(self) -> models.UserSettings | None:
+        return self.user.settings if self.user is not None else None
+
+    def bridge(self, bridge_id: str) -> models.HueBridge | None:
+        if self.settings is None:
+            return None
+        return next((bridge for bridge in self.settings.hue_bridges if bridge.id == bridge_id), None)
+
+    def wled(self, ip: str) -> models.WledItem | None:
+        if self.settings is None:
+            return None
+        return next((wled for wled in self.settings.wled_ips if wled.ip == ip), None)
+
+
+async def request_context(token: str = Depends(jwt_bearer)) -> AsyncIterator[RequestContext]:
+    async with AsyncSessionLocal() as session:
+        context = RequestContext(token, session)
+        # the user is read on the read engine, which is released again before
+        # the handler writes
+        async with AsyncReadSessionLocal() as read_session:
+            await context.load(read_session)
+        yield context
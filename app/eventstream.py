@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import httpx
+
+from .cache import device_cache
+from .consts import HTTP_CONNECT_TIMEOUT, HUE_EVENTSTREAM, HUE_EVENTSTREAM_SCHEME, HUE_EVENTSTREAM_SYNC_INTERVAL
+from .poller import poller
+from .routers.hue import LightHandler, bridge_key, fetch_bridge_lights
+from .serializer import loads
+from .sql_app import async_crud
+from .sql_app.database import AsyncReadSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+# @brief Maps a CLIP v2 light/connectivity update onto a v1 light state.
+def apply_event(state: dict, event: dict) -> dict:
+    state = {**state}
+    if "on" in event:
+        state["on"] = event["on"]["on"]
+    if "dimming" in event:
+        state["bri"] = max(1, round(event["dimming"]["brightness"] * 2.54))
+    if "color" in event and "xy" in event["color"]:
+        state["xy"] = [event["color"]["xy"]["x"], event["color"]["xy"]["y"]]
+        state["colormode"] = "xy"
+    if event.get("color_temperature", {}).get("mirek") is not None:
+        state["ct"] = event["color_temperature"]["mirek"]
+        state["colormode"] = "ct"
+    if "status" in event:
+        state["reachable"] = event["status"] == "connected"
+    return state
+
+
+# @brief Live subscription to the event stream of one Hue bridge row.
+#
+# Seeds the device cache with one full light list, pins it and then applies
+# every streamed change to it, so no further polling of the bridge is needed
+# while the stream is open.
+class BridgeSubscription:
+    def __init__(self, bridge_id: str, ip: str, user: str, user_id: int, client: httpx.AsyncClient):
+        self.bridge_id = bridge_id
+        self.ip = ip
+        self.user = user
+        self.user_id = user_id
+        self.__client__ = client
+        self.__task__: asyncio.Task | None = None
+
+    def start(self):
+        self.__task__ = asyncio.create_task(self.__run__())
+
+    async def stop(self):
+        if self.__task__ is None:
+            return
+        self.__task__.cancel()
+        try:
+            await self.__task__
+        except asyncio.CancelledError:
+            pass
+
+    async def __run__(self):
+        backoff = 1
+        while True:
+            try:
+                await self.__seed__()
+                await self.__listen__()
+                backoff = 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning(
+                    "Event stream of bridge %s failed: %s", self.ip, error)
+            finally:
+                device_cache.invalidate(bridge_key(self))
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+
+    async def __seed__(self):
+        device_cache.set(bridge_key(self), await fetch_bridge_lights(self), pinned=True)
+
+    async def __listen__(self):
+        async with self.__client__.stream(
+            "GET",
+            f"{HUE_EVENTSTREAM_SCHEME}://{self.ip}/eventstream/clip/v2",
+            headers={"hue-application-key": self.user,
+                     "Accept": "text/event-stream"},
+        ) as response:
+            response.raise_for_status()
+            data = []
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    data.append(line[5:].strip())
+                elif line == "" and len(data) > 0:
+                    await self.__handle__(loads("\n".join(data)))
+                    data = []
+
+    async def __handle__(self, messages: list[dict]):
+        lights = device_cache.get(bridge_key(self))
+        if lights is None:
+            return
+        lights = {**lights}
+        changed = set()
+        for message in messages:
+            if message.get("type") != "update":
+                continue
+            for event in message.get("data", []):
+                id_v1: str = event.get("id_v1") or ""
+                id = id_v1.removeprefix("/lights/")
+                if not id_v1.startswith("/lights/") or id not in lights:
+                    continue
+                lights[id] = {
+                    **lights[id],
+                    "state": apply_event(lights[id]["state"], event),
+                }
+                changed.add(id)
+
+        if len(changed) == 0:
+            return
+        device_cache.set(bridge_key(self), lights, pinned=True)
+        device_cache.invalidate(*(bridge_key(self, id) for id in changed))
+
+        normalizedLights = LightHandler.__mapLights__(
+            self.bridge_id, {id: lights[id] for id in changed})
+        normalizedPlugs = []
+        for id in changed:
+            plug = LightHandler.__mapPlug__(self.bridge_id, lights[id], id)
+            if plug is not None:
+                normalizedPlugs.append(plug)
+        await poller.publish(self.user_id, "light", normalizedLights)
+        await poller.publish(self.user_id, "plug", normalizedPlugs)
+
+
+# @brief Keeps one BridgeSubscription per configured Hue bridge row.
+class EventStreamManager:
+    def __init__(self, enabled: bool = HUE_EVENTSTREAM, interval: float = HUE_EVENTSTREAM_SYNC_INTERVAL):
+        self.enabled = enabled
+        self.interval = interval
+        self.__subscriptions__: dict[int, BridgeSubscription] = {}
+        self.__client__: httpx.AsyncClient | None = None
+        self.__task__: asyncio.Task | None = None
+
+    def start(self):
+        if not self.enabled or self.__task__ is not None:
+            return
+        # bridges serve the event stream with a self signed certificate
+        self.__client__ = httpx.AsyncClient(
+            verify=False,
+            timeout=httpx.Timeout(None, connect=HTTP_CONNECT_TIMEOUT),
+        )
+        self.__task__ = asyncio.create_task(self.__run__())
+
+    async def stop(self):
+        if self.__task__ is None:
+            return
+        self.__task__.cancel()
+        try:
+            await self.__task__
+        except asyncio.CancelledError:
+            pass
+        self.__task__ = None
+        for subscription in self.__subscriptions__.values():
+            await subscription.stop()
+        self.__subscriptions__.clear()
+        await self.__client__.aclose()
+
+    async def __run__(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("Syncing event streams failed")
+            await asyncio.sleep(self.interval)
+
+    async def sync(self):
+        async with AsyncReadSessionLocal() as db:
+            rows = await async_crud.get_hue_bridges_with_user_id(db)
+
+        wanted = {}
+        for bridge, user_id in rows:
+            wanted[bridge._id] = (bridge.id, bridge.ip, bridge.user, user_id)
+
+        for _id in [_id for _id in self.__subscriptions__ if _id not in wanted]:
+            await self.__subscriptions__.pop(_id).stop()
+
+        for _id, (bridge_id, ip, user, user_id) in wanted.items():
+            subscription = self.__subscriptions__.get(_id)
+            if subscription is not None and (subscription.ip, subscription.user) == (ip, user):
+                continue
+            if subscription is not None:
+                await subscription.stop()
+            subscription = BridgeSubscription(
+                bridge_id, ip, user, user_id, self.__client__)
+            subscription.start()
+            self.__subscriptions__[_id] = subscription
+
+
+event_streams = EventStreamManager()
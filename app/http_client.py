@@ -0,0 +1,58 @@
+import asyncio
+import httpx
+
+from .consts import DEVICE_RATE_MAX_WAIT, HTTP_CONNECT_TIMEOUT, HTTP_KEEPALIVE_EXPIRY, HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE, HTTP_TIMEOUT
+from .rate_limit import device_limiter
+
+
+# @brief Shared async HTTP client for talking to devices on the local network.
+#
+# Every device host gets its own connection pool, so a slow or unreachable
+# device can only exhaust its own connections and never blocks the others.
+# Requests to a device are throttled by `device_limiter`; a request that would
+# have to wait longer than DEVICE_RATE_MAX_WAIT raises RateLimitExceeded.
+class HttpClient:
+    def __init__(self):
+        self.__clients__: dict[str, httpx.AsyncClient] = {}
+        self.__timeout__ = httpx.Timeout(
+            HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        self.__limits__ = httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+
+    def client(self, host: str) -> httpx.AsyncClient:
+        client = self.__clients__.get(host)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                base_url=f"http://{host}",
+                timeout=self.__timeout__,
+                limits=self.__limits__,
+            )
+            self.__clients__[host] = client
+        return client
+
+    async def request(self, method: str, host: str, path: str, **kwargs) -> httpx.Response:
+        wait = device_limiter.reserve(host, DEVICE_RATE_MAX_WAIT)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return await self.client(host).request(method, path, **kwargs)
+
+    async def get(self, host: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", host, path, **kwargs)
+
+    async def put(self, host: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request("PUT", host, path, **kwargs)
+
+    async def post(self, host: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", host, path, **kwargs)
+
+    async def close(self):
+        clients = list(self.__clients__.values())
+        self.__clients__.clear()
+        for client in clients:
+            await client.aclose()
+
+
+http_client = HttpClient()
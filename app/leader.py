@@ -0,0 +1,140 @@
+import asyncio
+import fcntl
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+from .consts import LEADER_INTERVAL, LEADER_LOCK_FILE, LEADER_TTL, PUBSUB_URL
+
+logger = logging.getLogger(__name__)
+
+
+# @brief Leadership held through an exclusive lock on a file, for the workers
+# of one host. The kernel drops the lock when the holding process dies.
+class FileLeaderLock:
+    def __init__(self, path: str = LEADER_LOCK_FILE):
+        self.path = path
+        self.__file__ = None
+
+    async def acquire(self) -> bool:
+        if self.__file__ is not None:
+            return True
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self.__file__ = file
+        return True
+
+    async def renew(self) -> bool:
+        return self.__file__ is not None
+
+    async def release(self):
+        if self.__file__ is None:
+            return
+        fcntl.flock(self.__file__, fcntl.LOCK_UN)
+        self.__file__.close()
+        self.__file__ = None
+
+
+# @brief Leadership held through a Redis key with a TTL, for workers spread
+# over several hosts. The key has to be renewed before it expires.
+class RedisLeaderLock:
+    RENEW = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("pexpire", KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE = """
+    if redis.call("get", KEYS[1]) == ARGV[1] then
+        return redis.call("del", KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, key: str = "homeapi:leader", ttl: float = LEADER_TTL, client=None):
+        if client is None:
+            try:
+                from redis import asyncio as redis
+            except ImportError as error:
+                raise RuntimeError(
+                    "PUBSUB_URL points to redis but the redis package is not installed") from error
+            client = redis.from_url(url)
+        self.key = key
+        self.ttl = int(ttl * 1000)
+        self.__client__ = client
+        self.__token__ = f"{os.getpid()}-{uuid.uuid4()}"
+
+    async def acquire(self) -> bool:
+        return bool(await self.__client__.set(self.key, self.__token__, nx=True, px=self.ttl))
+
+    async def renew(self) -> bool:
+        return bool(await self.__client__.eval(self.RENEW, 1, self.key, self.__token__, self.ttl))
+
+    async def release(self):
+        await self.__client__.eval(self.RELEASE, 1, self.key, self.__token__)
+
+
+# @brief Runs the background jobs that must exist once per deployment (device
+# poller, bridge event streams) only in the worker that holds the lock.
+#
+# Every worker keeps trying to become leader, so when the leader exits another
+# worker takes over within `interval` seconds.
+class LeaderElection:
+    def __init__(self, lock, on_elected: Callable[[], Awaitable], on_demoted: Callable[[], Awaitable],
+                 interval: float = LEADER_INTERVAL):
+        self.lock = lock
+        self.interval = interval
+        self.leader = False
+        self.__on_elected__ = on_elected
+        self.__on_demoted__ = on_demoted
+        self.__task__: asyncio.Task | None = None
+
+    async def start(self):
+        await self.__step__()
+        self.__task__ = asyncio.create_task(self.__run__())
+
+    async def stop(self):
+        if self.__task__ is not None:
+            self.__task__.cancel()
+            try:
+                await self.__task__
+            except asyncio.CancelledError:
+                pass
+            self.__task__ = None
+        if self.leader:
+            self.leader = False
+            await self.__on_demoted__()
+            await self.lock.release()
+
+    async def __run__(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.__step__()
+            except Exception:
+                logger.exception("Leader election failed")
+
+    async def __step__(self):
+        if self.leader:
+            if not await self.lock.renew():
+                logger.warning("Lost leadership, stopping background jobs")
+                self.leader = False
+                await self.__on_demoted__()
+        elif await self.lock.acquire():
+            logger.info("Elected leader, starting background jobs")
+            self.leader = True
+            await self.__on_elected__()
+
+
+# @brief Lock matching the pub/sub backend: Redis when the workers share a
+# Redis, a lock file otherwise.
+def create_leader_lock(url: str = PUBSUB_URL):
+    if urlparse(url).scheme in ("redis", "rediss"):
+        return RedisLeaderLock(url)
+    return FileLeaderLock()
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .auth_handler import signJWT
+from .cache import device_cache
+from .consts import POLL_INTERVAL, LightRecord, PlugRecord
+from .context import RequestContext
+from .routers.main import LightHandler
+from .sql_app import async_crud, models
+from .sql_app.database import AsyncReadSessionLocal
+from .state_store import DeviceStateStore, device_states
+from .websocket import manager
+
+logger = logging.getLogger(__name__)
+
+
+# @brief Keeps device state warm and pushes changes to connected clients.
+#
+# Every `interval` seconds the poller reads the lights and plugs of every
+# user, compares them with the previous poll and sends only the changed ones
+# to that user's websocket connections. This also catches changes made
+# outside of the API (Hue app, wall switches, WLED web UI).
+class DevicePoller:
+    def __init__(self, interval: float = POLL_INTERVAL, store: DeviceStateStore = device_states):
+        self.interval = interval
+        self.__task__: asyncio.Task | None = None
+        self.store = store
+
+    def start(self):
+        if self.interval <= 0 or self.__task__ is not None:
+            return
+        self.__task__ = asyncio.create_task(self.__run__())
+
+    async def stop(self):
+        if self.__task__ is None:
+            return
+        self.__task__.cancel()
+        try:
+            await self.__task__
+        except asyncio.CancelledError:
+            pass
+        self.__task__ = None
+
+    async def __run__(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception:
+                logger.exception("Polling devices failed")
+            await asyncio.sleep(self.interval)
+
+    async def poll(self):
+        async with AsyncReadSessionLocal() as db:
+            users = []
+            while True:
+                page = await async_crud.get_users_with_settings(db, skip=len(users))
+                users.extend(page)
+                if len(page) < 100:
+                    break
+            await asyncio.gather(*(self.__pollUser__(db, user) for user in users))
+        for owner in self.store.owners() - {user.id for user in users}:
+            self.store.remove_owner(owner)
+
+    async def __pollUser__(self, db: AsyncSession, user: models.User):
+        handler = LightHandler(RequestContext(
+            signJWT(user.email)["access_token"], db, user))
+        handler.hue.max_age = device_cache.ttl
+        handler.wled.max_age = device_cache.ttl
+        try:
+            devices = await handler.allDevices()
+        except Exception:
+            logger.exception("Polling devices of %s failed", user.username)
+            return
+
+        for type, records in devices.items():
+            await self.publish(user.id, type, records, initial=True)
+
+        # devices that a complete poll no longer reports were removed; after a
+        # failed bridge or WLED request the poll is incomplete
+        if len(handler.hue.errors) == 0 and len(handler.wled.errors) == 0:
+            for type, records in devices.items():
+                self.store.prune(user.id, type, {record.id for record in records})
+
+    # @brief Sends the devices that differ from the last known snapshot.
+    #
+    # With `initial` set, the first snapshot of a user is only recorded, so a
+    # restart doesn't push every device to every client.
+    async def publish(self, user_id: int, type: str, devices: list[LightRecord | PlugRecord], initial: bool = False):
+        for change in self.__diff__(user_id, type, devices, initial):
+            await manager.send_to_user(user_id, change)
+
+    def __diff__(self, user_id: int, type: str, devices: list[LightRecord | PlugRecord], initial: bool) -> list[dict]:
+        silent = initial and not self.store.has(user_id, type)
+        changed = self.store.update(user_id, type, devices)
+        if silent:
+            return []
+        return [{"type": type, "data": device} for device in changed]
+
+
+poller = DevicePoller()
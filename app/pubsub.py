@@ -0,0 +1,206 @@
+import asyncio
+import fcntl
+import logging
+import os
+import struct
+from typing import Callable
+from urllib.parse import urlparse
+
+from .consts import PUBSUB_CHANNEL, PUBSUB_URL
+from .serializer import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], None]
+
+HEADER = struct.Struct("!I")
+
+
+# @brief In-process bus, every message is handed straight to the local handler.
+class MemoryPubSub:
+    def __init__(self):
+        self.__handler__: Handler | None = None
+
+    async def start(self, handler: Handler):
+        self.__handler__ = handler
+
+    async def stop(self):
+        self.__handler__ = None
+
+    async def publish(self, message: dict):
+        if self.__handler__ is not None:
+            self.__handler__(message)
+
+
+# @brief Bus between the workers of one host over a unix socket.
+#
+# The first worker that manages to bind the socket becomes the hub and relays
+# every frame to all other workers; the others connect to it. Publishing
+# delivers locally right away and sends the message to the bus once. If the
+# hub goes away the remaining workers race for the socket again, guarded by a
+# lock file so a stale socket is only replaced once.
+class UnixSocketPubSub:
+    def __init__(self, path: str):
+        self.path = path
+        self.__handler__: Handler | None = None
+        self.__task__: asyncio.Task | None = None
+        self.__hub__: asyncio.AbstractServer | None = None
+        self.__peers__: set[asyncio.StreamWriter] = set()
+        self.__writer__: asyncio.StreamWriter | None = None
+
+    async def start(self, handler: Handler):
+        self.__handler__ = handler
+        self.__task__ = asyncio.create_task(self.__run__())
+
+    async def stop(self):
+        if self.__task__ is not None:
+            self.__task__.cancel()
+            try:
+                await self.__task__
+            except asyncio.CancelledError:
+                pass
+            self.__task__ = None
+        if self.__hub__ is not None:
+            self.__hub__.close()
+            self.__hub__ = None
+        for writer in [*self.__peers__, self.__writer__]:
+            if writer is not None:
+                writer.close()
+        self.__peers__.clear()
+        self.__writer__ = None
+
+    async def publish(self, message: dict):
+        self.__handler__(message)
+        frame = self.__frame__(dumps(message))
+        if self.__writer__ is not None:
+            self.__writer__.write(frame)
+        for peer in list(self.__peers__):
+            peer.write(frame)
+
+    @staticmethod
+    def __frame__(data: bytes) -> bytes:
+        return HEADER.pack(len(data)) + data
+
+    @staticmethod
+    async def __read__(reader: asyncio.StreamReader) -> bytes:
+        size = HEADER.unpack(await reader.readexactly(HEADER.size))[0]
+        return await reader.readexactly(size)
+
+    async def __run__(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if await self.__bind__():
+                    await self.__hub__.serve_forever()
+                continue
+            except OSError as error:
+                logger.warning("Connecting to %s failed: %s", self.path, error)
+                await asyncio.sleep(1)
+                continue
+            self.__writer__ = writer
+            try:
+                while True:
+                    self.__handler__(loads(await self.__read__(reader)))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self.__writer__ = None
+                writer.close()
+
+    # @brief Becomes the hub unless another worker did so in the meantime.
+    async def __bind__(self) -> bool:
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    _, writer = await asyncio.open_unix_connection(self.path)
+                    writer.close()
+                    return False
+                except (FileNotFoundError, ConnectionRefusedError):
+                    pass
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                self.__hub__ = await asyncio.start_unix_server(self.__serve__, self.path)
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    async def __serve__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.__peers__.add(writer)
+        try:
+            while True:
+                data = await self.__read__(reader)
+                self.__handler__(loads(data))
+                frame = self.__frame__(data)
+                for peer in list(self.__peers__):
+                    if peer is not writer:
+                        peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.__peers__.discard(writer)
+            writer.close()
+
+
+# @brief Bus over Redis (or anything speaking its pub/sub commands).
+#
+# Messages are published once and every worker, the publishing one included,
+# delivers them from its subscription. `client` may be any redis.asyncio
+# compatible client, e.g. a local stand-in.
+class RedisPubSub:
+    def __init__(self, url: str, channel: str = PUBSUB_CHANNEL, client=None):
+        if client is None:
+            try:
+                from redis import asyncio as redis
+            except ImportError as error:
+                raise RuntimeError(
+                    "PUBSUB_URL points to redis but the redis package is not installed") from error
+            client = redis.from_url(url)
+        self.channel = channel
+        self.__client__ = client
+        self.__handler__: Handler | None = None
+        self.__task__: asyncio.Task | None = None
+
+    async def start(self, handler: Handler):
+        self.__handler__ = handler
+        subscription = self.__client__.pubsub()
+        await subscription.subscribe(self.channel)
+        self.__task__ = asyncio.create_task(self.__run__(subscription))
+
+    async def stop(self):
+        if self.__task__ is not None:
+            self.__task__.cancel()
+            try:
+                await self.__task__
+            except asyncio.CancelledError:
+                pass
+            self.__task__ = None
+        await self.__client__.close()
+
+    async def publish(self, message: dict):
+        await self.__client__.publish(self.channel, dumps(message))
+
+    async def __run__(self, subscription):
+        try:
+            while True:
+                message = await subscription.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is not None:
+                    self.__handler__(loads(message["data"]))
+        finally:
+            await subscription.close()
+
+
+PubSub = MemoryPubSub | UnixSocketPubSub | RedisPubSub
+
+
+# @brief Bus for `url`: memory://, unix:///path/to/socket or redis://host:port/db.
+def create_pubsub(url: str = PUBSUB_URL) -> PubSub:
+    scheme = urlparse(url).scheme
+    if scheme == "unix":
+        return UnixSocketPubSub(urlparse(url).path)
+    if scheme in ("redis", "rediss"):
+        return RedisPubSub(url)
+    if scheme == "memory":
+        return MemoryPubSub()
+    raise ValueError(f"Unsupported PUBSUB_URL {url}")
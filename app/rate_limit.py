@@ -0,0 +1,78 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Hashable
+from fastapi import Depends
+
+from .auth_bearer import jwt_bearer
+from .auth_handler import decodeJWT, verified_tokens
+from .consts import DEVICE_RATE_BURST, DEVICE_RATE_LIMIT, USER_RATE_BURST, USER_RATE_LIMIT
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.2f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    # @brief Takes one token and returns how long the caller has to wait for it.
+    #
+    # Tokens can be reserved ahead of time (the bucket goes negative), which
+    # keeps callers that wait in the order they arrived.
+    def reserve(self, max_wait: float) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        if wait > max_wait:
+            raise RateLimitExceeded(wait)
+        self.tokens -= 1
+        return wait
+
+
+# @brief Token buckets per key (user, device host, ...).
+#
+# Only the `max_keys` most recently used buckets are kept. A rate of 0
+# disables the limiter.
+class RateLimiter:
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.__buckets__: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+
+    def reserve(self, key: Hashable, max_wait: float = 0) -> float:
+        if self.rate <= 0:
+            return 0
+        bucket = self.__buckets__.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.__buckets__[key] = bucket
+            if len(self.__buckets__) > self.max_keys:
+                self.__buckets__.popitem(last=False)
+        self.__buckets__.move_to_end(key)
+        return bucket.reserve(max_wait)
+
+
+user_limiter = RateLimiter(USER_RATE_LIMIT, USER_RATE_BURST)
+device_limiter = RateLimiter(DEVICE_RATE_LIMIT, DEVICE_RATE_BURST)
+
+
+def retry_after_header(retry_after: float) -> dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+# @brief Router dependency limiting the requests per user. A RateLimitExceeded
+# is answered by the app's handler with 429 and Retry-After, like the device
+# limiter.
+async def user_rate_limit(token: str = Depends(jwt_bearer)):
+    email = verified_tokens.get(token) or (decodeJWT(token) or {}).get("email")
+    user_limiter.reserve(email or token)
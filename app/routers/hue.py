@@ -1,166 +1,287 @@
-from typing import Optional
+import asyncio
+from typing import Awaitable, Callable, Optional
 from fastapi import APIRouter, Depends, Response
-from fastapi.responses import JSONResponse
-from fastapi_sqlalchemy import db
 from pydantic import BaseModel
-import requests
-import colorsys
-from sqlalchemy.orm import Session
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
-from ..model import UserSchema
-from ..auth_handler import decodeJWT
-from ..auth_bearer import JWTBearer
-from ..consts import ErrorResponse, HueLightResponse, HueLightState, HuePlugResponse, HuePlugState, Light, LightState, Plug, WebSocketMessage
+from .. import color
+from ..auth_bearer import jwt_bearer
+from ..context import RequestContext, request_context
+from ..rate_limit import RateLimitExceeded, user_rate_limit
+from ..consts import HUE_BRIDGE_TIMEOUT, HUE_RECONCILE_DELAY, ErrorResponse, HueGroupResponse, HueLightResponse, HueLightState, HuePlugResponse, HuePlugState, LightRecord, LightState, PlugRecord, WebSocketMessage
+from ..serializer import JSONResponse
 from ..websocket import broadcast
-from ..sql_app import crud
+from ..http_client import http_client
+from ..cache import device_cache
+from ..sql_app import async_crud
 
 router = APIRouter(
     tags=["hue"],
     responses={404: {"description": "Not found"}},
-    dependencies=[Depends(JWTBearer())]
+    dependencies=[Depends(jwt_bearer), Depends(user_rate_limit)]
 )
 
 
-def user_by_token(db: Session, token: str) -> Optional[UserSchema]:
-    email = (decodeJWT(token) or {}).get("email")
-    return crud.get_user_by_email(db, email) if email else None
+def bridge_key(bridge, id: int | str | None = None) -> tuple:
+    if id is None:
+        return ("hue", bridge.ip, bridge.user)
+    return ("hue", bridge.ip, bridge.user, str(id))
 
 
-class LightHandler:
-    token: str
-    db: Session
+def groups_key(bridge) -> tuple:
+    return ("hue-groups", bridge.ip, bridge.user)
 
-    def __init__(self, token: str, db: Session):
-        self.token = token
-        self.db = db
 
-    def __hsb_to_hsv__(self, hue: float, saturation: float, brightness: float) -> tuple[float, float, float]:
-        return (hue/65535*360, saturation/255*100, brightness/255*100)
+async def fetch_bridge_lights(bridge) -> dict:
+    lights = await http_client.get(bridge.ip, f"/api/{bridge.user}/lights")
+    return lights.json()
 
-    def __hsv_to_rgb__(self, hue: float, saturation: float, brightness: float) -> tuple[int, int, int]:
-        return tuple(round(i * 255) for i in colorsys.hsv_to_rgb(hue / 360, saturation / 100, brightness / 100))
 
-    def __rgb_to_hsv__(self, red: int, green: int, blue: int) -> tuple[float, float, float]:
-        hsv = colorsys.rgb_to_hsv(red / 255, green / 255, blue / 255)
-        return (hsv[0] * 360, hsv[1] * 100, hsv[2] * 100)
+# @brief Merges the success entries of a state or group action PUT into the
+# cached lights, so the new state is known without reading it back.
+#
+# Lights that are not cached (or whose response can't be used) are
+# invalidated instead and read from the bridge on the next access.
+def apply_state_response(bridge, lights: list[str], response):
+    changes = {}
+    try:
+        results = response.json() if response.status_code == 200 else []
+    except ValueError:
+        results = []
+    for result in results if isinstance(results, list) else []:
+        for path, value in (result.get("success") or {}).items():
+            changes[path.rsplit("/", 1)[-1]] = value
+    if "hue" in changes or "sat" in changes:
+        changes["colormode"] = "hs"
+    elif "xy" in changes:
+        changes["colormode"] = "xy"
+    elif "ct" in changes:
+        changes["colormode"] = "ct"
+
+    cached = device_cache.get(bridge_key(bridge), device_cache.ttl)
+    merged = {**cached} if cached is not None else None
+    for id in lights:
+        light = device_cache.get(bridge_key(bridge, id), device_cache.ttl)
+        if light is None and merged is not None:
+            light = merged.get(id)
+        if light is None or len(changes) == 0:
+            device_cache.invalidate(bridge_key(bridge, id))
+            merged = None
+            continue
+        light = {
+            **light,
+            "state": {**light["state"], **{key: value for key, value in changes.items() if key in light["state"]}},
+        }
+        device_cache.set(bridge_key(bridge, id), light)
+        if merged is not None:
+            merged[id] = light
+
+    if merged is not None:
+        device_cache.set(bridge_key(bridge), merged)
+    elif not device_cache.is_pinned(bridge_key(bridge)):
+        device_cache.invalidate(bridge_key(bridge))
+
+    if HUE_RECONCILE_DELAY > 0:
+        reconcile(bridge, lights)
+
+
+class PendingReconcile:
+    def __init__(self, deadline: float, lights: list[str]):
+        self.deadline = deadline
+        self.lights = set(lights)
+
+
+# reconciles waiting to run, at most one per bridge
+pending_reconciles: dict[tuple, PendingReconcile] = {}
+
+
+# @brief Reads the lights of a bridge again shortly after a write, in case the
+# bridge didn't apply the state as reported.
+#
+# Writes to a bridge with a reconcile already waiting only push its deadline
+# back, so a burst of writes ends in one read after the last of them.
+def reconcile(bridge, lights: list[str]):
+    ip, user = bridge.ip, bridge.user
+    key = bridge_key(bridge)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + HUE_RECONCILE_DELAY
+
+    pending = pending_reconciles.get(key)
+    if pending is not None:
+        pending.deadline = deadline
+        pending.lights.update(lights)
+        return
+    pending = PendingReconcile(deadline, lights)
+    pending_reconciles[key] = pending
+
+    async def run():
+        try:
+            while pending.deadline > loop.time():
+                await asyncio.sleep(pending.deadline - loop.time())
+        finally:
+            # writes from here on need a read of their own
+            del pending_reconciles[key]
+        response = await http_client.get(ip, f"/api/{user}/lights")
+        if device_cache.is_pinned(key) or response.status_code != 200:
+            return
+        state = response.json()
+        # bridges report errors as a list, e.g. [{"error": ...}]
+        if not isinstance(state, dict):
+            return
+        device_cache.set(key, state)
+        device_cache.invalidate(*(key + (id,) for id in pending.lights))
+
+    task = asyncio.ensure_future(run())
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+
+def bridge_error_headers(errors: dict[str, str]) -> dict[str, str] | None:
+    if len(errors) == 0:
+        return None
+    return {"X-Bridge-Errors": ",".join(f"{bridge_id}={error}" for bridge_id, error in errors.items())}
 
-    def __hsv_to_hsb__(self, hue: float, saturation: float, brightness: float) -> tuple[float, float, float]:
-        return (hue/360*65535, saturation/100*255, brightness/100*255)
 
-    def __mapLight__(self, bridge_id: str, light, id: int) -> Light | None:
+class LightHandler:
+    token: str
+    db: AsyncSession
+    context: RequestContext
+    errors: dict[str, str]
+    max_age: float | None
+
+    def __init__(self, context: RequestContext):
+        self.token = context.token
+        self.db = context.db
+        self.context = context
+        self.errors = {}
+        self.max_age = None
+
+    @staticmethod
+    def __gamut__(light) -> list | None:
+        return light.get("capabilities", {}).get("control", {}).get("colorgamut")
+
+    @staticmethod
+    def __mapLight__(bridge_id: str, light, id: int, rgb: tuple[int, int, int] | None = None) -> LightRecord | None:
         if "colormode" not in light["state"]:
             return None
 
-        hsv = self.__hsb_to_hsv__(
-            light["state"]["hue"],
-            light["state"]["sat"],
-            light["state"]["bri"]
+        if rgb is None:
+            rgb = tuple(color.light_colors(
+                [light["state"]], [LightHandler.__gamut__(light)])[0].tolist())
+
+        return LightRecord(
+            id=f"hue-{bridge_id}-{id}",
+            name=light["name"],
+            on=light["state"]["on"],
+            brightness=float(light["state"]["bri"]) / 255,
+            color=(rgb,),
+            reachable=light["state"]["reachable"],
+            type=light["type"],
+            model=light["modelid"],
+            manufacturer=light["manufacturername"],
+            uniqueid=light["uniqueid"],
+            swversion=light["swversion"],
+            productid=light["productid"]
         )
-        rgb = self.__hsv_to_rgb__(hsv[0], hsv[1], hsv[2])
 
-        light = {
-            "id": f"hue-{bridge_id}-{id}",
-            "name": light["name"],
-            "on": light["state"]["on"],
-            "brightness": float(light["state"]["bri"]) / 255,
-            "color": [rgb],
-            "reachable": light["state"]["reachable"],
-            "type": light["type"],
-            "model": light["modelid"],
-            "manufacturer": light["manufacturername"],
-            "uniqueid": light["uniqueid"],
-            "swversion": light["swversion"],
-            "productid": light["productid"]
-        }
-
-        return Light.from_dict(light)
-
-    def __mapPlug__(self, bridge_id: str, plug, id: int) -> Plug | None:
+    # @brief Maps a whole light list of one bridge, converting all colours in
+    # one batch.
+    @staticmethod
+    def __mapLights__(bridge_id: str, lights: dict) -> list[LightRecord]:
+        ids = [id for id in lights if "colormode" in lights[id]["state"]]
+        colors = color.light_colors(
+            [lights[id]["state"] for id in ids],
+            [LightHandler.__gamut__(lights[id]) for id in ids],
+        ).tolist()
+        return [LightHandler.__mapLight__(bridge_id, lights[id], id, tuple(rgb))
+                for id, rgb in zip(ids, colors)]
+
+    @staticmethod
+    def __mapPlug__(bridge_id: str, plug, id: int) -> PlugRecord | None:
         if plug["config"]["archetype"] != "plug":
             return None
 
-        new_plug = {
-            "id": f"hue-{bridge_id}-{id}",
-            "name": plug["name"],
-            "on": plug["state"]["on"],
-            "reachable": plug["state"]["reachable"],
-            "type": plug["type"],
-            "model": plug["modelid"],
-            "manufacturer": plug["manufacturername"],
-            "uniqueid": plug["uniqueid"],
-            "swversion": plug["swversion"],
-            "productid": plug["productid"]
-        }
-
-        return Plug.from_dict(new_plug)
-
-    def __user_by_token__(self):
-        return user_by_token(self.db, self.token)
+        return PlugRecord(
+            id=f"hue-{bridge_id}-{id}",
+            name=plug["name"],
+            on=plug["state"]["on"],
+            reachable=plug["state"]["reachable"],
+            type=plug["type"],
+            model=plug["modelid"],
+            manufacturer=plug["manufacturername"],
+            uniqueid=plug["uniqueid"],
+            swversion=plug["swversion"],
+            productid=plug["productid"]
+        )
 
     def __config_by_token__(self):
-        user = user_by_token(self.db, self.token)
-        return user.settings if user else None
+        return self.context.settings
 
-    def getLightsBride(self, bride_id: str):
-        user = self.__user_by_token__()
-        bridge = crud.get_hue_bridge_by_id(
-            self.db, user.email, bride_id) if user else None
+    async def getLightsBride(self, bride_id: str):
+        bridge = self.context.bridge(bride_id)
         if bridge is None:
             return None
-        lights = requests.get(
-            f"http://{bridge.ip}/api/{bridge.user}/lights")
-        return lights.json()
 
-    def __getLights__(self):
+        return await device_cache.fetch(bridge_key(bridge), lambda: fetch_bridge_lights(bridge), self.max_age)
+
+    async def __fetchBridge__(self, bridge_id: str, fetch: Callable[[str], Awaitable]):
+        try:
+            return await asyncio.wait_for(fetch(bridge_id), HUE_BRIDGE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.errors[bridge_id] = "timeout"
+        except RateLimitExceeded:
+            self.errors[bridge_id] = "rate_limited"
+        except (httpx.HTTPError, ValueError):
+            self.errors[bridge_id] = "unreachable"
+        return None
+
+    async def __fetchBridges__(self, fetch: Callable[[str], Awaitable]) -> list[tuple[str, object]]:
         config = self.__config_by_token__()
         if config is None:
-            return {}
-        bridges = config.hue_bridges
+            return []
+        bridge_ids = [bridge.id for bridge in config.hue_bridges]
+        results = await asyncio.gather(*(
+            self.__fetchBridge__(bridge_id, fetch) for bridge_id in bridge_ids
+        ))
+        return list(zip(bridge_ids, results))
+
+    async def __getLights__(self):
         lights = {}
-        for bridge in bridges:
-            lights_bridge = self.getLightsBride(bridge.id)
+        for _, lights_bridge in await self.__fetchBridges__(self.getLightsBride):
             if lights_bridge is not None:
                 lights.update(lights_bridge)
         return lights
 
-    def getLights(self):
-        config = self.__config_by_token__()
-        if config is None:
-            return []
-        bridges = config.hue_bridges
+    async def getLights(self):
         normalizedLights = []
-        for bridge in bridges:
-            lights = self.getLightsBride(bridge.id)
+        for bridge_id, lights in await self.__fetchBridges__(self.getLightsBride):
             if lights is not None:
-                for light in lights:
-                    normalized = self.__mapLight__(
-                        bridge.id, lights[light], light)
-                    if normalized is not None:
-                        normalizedLights.append(normalized)
+                normalizedLights.extend(self.__mapLights__(bridge_id, lights))
         return normalizedLights
 
-    def __getLight__(self, bridge_id: str, id: int):
-        db_user = self.__user_by_token__()
-        if db_user is None:
-            return None
-        bridge = crud.get_hue_bridge_by_id(self.db, db_user.email, bridge_id)
+    async def __getLight__(self, bridge_id: str, id: int):
+        bridge = self.context.bridge(bridge_id)
         if bridge is None or bridge.ip == "" or bridge.user == "":
             return None
-        light = requests.get(
-            f"http://{bridge.ip}/api/{bridge.user}/lights/{id}")
-        return light.json()
 
-    def getLight(self, bridge_id: str, id: int):
+        async def fetch():
+            light = await http_client.get(
+                bridge.ip, f"/api/{bridge.user}/lights/{id}")
+            return light.json()
+
+        return await device_cache.fetch(bridge_key(bridge, id), fetch, self.max_age)
+
+    async def getLight(self, bridge_id: str, id: int):
         config = self.__config_by_token__()
         if config is None:
             return None
-        light = self.__getLight__(bridge_id, id)
+        light = await self.__getLight__(bridge_id, id)
         normalizedLight = self.__mapLight__(bridge_id, light, id)
         return normalizedLight
 
-    def getPlugsBride(self, bridge_id: str):
-        lights = self.getLightsBride(bridge_id)
+    async def getPlugsBride(self, bridge_id: str):
+        lights = await self.getLightsBride(bridge_id)
         plugs = {}
         if lights is not None:
             for light in lights:
@@ -168,71 +289,133 @@ class LightHandler:
                     plugs[light] = lights[light]
         return plugs
 
-    def __getPlugs__(self):
-        lights = self.__getLights__()
+    async def __getPlugs__(self):
+        lights = await self.__getLights__()
         plugs = {}
         for light in lights:
             if lights[light].get("config", {}).get("archetype") == "plug":
                 plugs[light] = lights[light]
         return plugs
 
-    def getPlugs(self):
-        config = self.__config_by_token__()
-        if config is None:
-            return []
-        bridges = config.hue_bridges
+    async def getPlugs(self):
         normalizedPlugs = []
-        for bridge in bridges:
-            plugs = self.getPlugsBride(bridge.id)
+        for bridge_id, plugs in await self.__fetchBridges__(self.getPlugsBride):
+            if plugs is None:
+                continue
             for plug in plugs:
-                normalized = self.__mapPlug__(bridge.id, plugs[plug], plug)
+                normalized = self.__mapPlug__(bridge_id, plugs[plug], plug)
                 if normalized is not None:
                     normalizedPlugs.append(normalized)
         return normalizedPlugs
 
-    def __getPlug__(self, bridge_id: str, id: int):
-        plug = self.__getLight__(bridge_id, id)
+    async def __getPlug__(self, bridge_id: str, id: int):
+        plug = await self.__getLight__(bridge_id, id)
         if plug is None or plug["config"]["archetype"] != "plug":
             return None
         return plug
 
-    def getPlug(self, bridge_id: str, id: int):
-        plug = self.__getPlug__(bridge_id, id)
+    async def getPlug(self, bridge_id: str, id: int):
+        plug = await self.__getPlug__(bridge_id, id)
         if plug is None:
             return None
         return self.__mapPlug__(bridge_id, plug, id)
 
-    def __setLightState__(self, bridge_id: str, id: int, state: HueLightState):
-        user = self.__user_by_token__()
-        if user is None:
-            return None
-        bridge = crud.get_hue_bridge_by_id(self.db, user.email, bridge_id)
+    async def __setLightState__(self, bridge_id: str, id: int, state: HueLightState):
+        bridge = self.context.bridge(bridge_id)
         if bridge is None:
             return None
 
-        return requests.put(
-            f"http://{bridge.ip}/api/{bridge.user}/lights/{id}/state", json=state.to_dict())
+        response = await http_client.put(
+            bridge.ip, f"/api/{bridge.user}/lights/{id}/state", json=state.to_dict())
+        apply_state_response(bridge, [str(id)], response)
+        return response
 
-    def setLightState(self, bridge_id: str, id: int, state: LightState):
-        new_state = HueLightState.from_dict({})
+    async def getGroupsBridge(self, bridge_id: str):
+        bridge = self.context.bridge(bridge_id)
+        if bridge is None or bridge.ip == "" or bridge.user == "":
+            return None
 
-        if state.brightness is not None:
-            new_state.bri = round(state.brightness / 100 * 255)
+        async def fetch():
+            groups = await http_client.get(
+                bridge.ip, f"/api/{bridge.user}/groups")
+            return groups.json()
 
-        if state.color is not None and len(state.color) > 0:
-            hsv = self.__rgb_to_hsv__(
-                state.color[0][0],
-                state.color[0][1],
-                state.color[0][2]
-            )
-            hsb = self.__hsv_to_hsb__(hsv[0], hsv[1], hsv[2])
-            new_state.hue = round(hsb[0])
-            new_state.sat = round(hsb[1])
+        return await device_cache.fetch(groups_key(bridge), fetch, self.max_age)
 
-        if state.on is not None:
-            new_state.on = state.on
+    async def __setGroupAction__(self, bridge_id: str, id: str, lights: list[str], state: HueLightState):
+        bridge = self.context.bridge(bridge_id)
+        if bridge is None:
+            return None
 
-        return self.__setLightState__(bridge_id, id, new_state)
+        response = await http_client.put(
+            bridge.ip, f"/api/{bridge.user}/groups/{id}/action", json=state.to_dict())
+        device_cache.invalidate(groups_key(bridge))
+        apply_state_response(bridge, lights, response)
+        return response
+
+    # @brief Sets the state of many lights of one bridge.
+    #
+    # Lights that get the same state and together make up a whole group are
+    # switched with one group action, all other lights one by one.
+    async def setLightsState(self, bridge_id: str, updates: list[tuple[int, LightState]]) -> dict[int, object]:
+        states: dict[str, tuple[HueLightState, set[str]]] = {}
+        hue_states = self.__toHueStates__([state for _, state in updates])
+        for (id, _), hue_state in zip(updates, hue_states):
+            states.setdefault(hue_state.json(exclude_none=True),
+                              (hue_state, set()))[1].add(str(id))
+
+        groups = {}
+        if any(len(ids) > 1 for _, ids in states.values()):
+            groups = await self.getGroupsBridge(bridge_id) or {}
+        groups = sorted(groups.items(), key=lambda group: -
+                        len(group[1].get("lights", [])))
+
+        responses = {}
+        for hue_state, ids in states.values():
+            for group_id, group in groups:
+                lights = set(group.get("lights", []))
+                if len(ids) < 2 or len(lights) < 2 or not lights <= ids:
+                    continue
+                response = await self.__setGroupAction__(bridge_id, group_id, list(lights), hue_state)
+                for id in lights:
+                    responses[int(id)] = response
+                ids = ids - lights
+            for id in ids:
+                responses[int(id)] = await self.__setLightState__(bridge_id, int(id), hue_state)
+        return responses
+
+    @staticmethod
+    def __toHueState__(state: LightState) -> HueLightState:
+        return LightHandler.__toHueStates__([state])[0]
+
+    # @brief Converts many LightStates at once, doing the rgb to hue/sat
+    # conversion of all requested colours in one batch.
+    @staticmethod
+    def __toHueStates__(states: list[LightState]) -> list[HueLightState]:
+        colored = [index for index, state in enumerate(states)
+                   if state.color is not None and len(state.color) > 0]
+        hue, sat, _ = color.rgb_to_hsb(
+            [states[index].color[0] for index in colored] or [(0, 0, 0)])
+        hue_sat = dict(zip(colored, zip(hue.tolist(), sat.tolist())))
+
+        new_states = []
+        for index, state in enumerate(states):
+            new_state = HueLightState.from_dict({})
+
+            if state.brightness is not None:
+                new_state.bri = round(state.brightness / 100 * 255)
+
+            if index in hue_sat:
+                new_state.hue, new_state.sat = hue_sat[index]
+
+            if state.on is not None:
+                new_state.on = state.on
+
+            new_states.append(new_state)
+        return new_states
+
+    async def setLightState(self, bridge_id: str, id: int, state: LightState):
+        return await self.__setLightState__(bridge_id, id, self.__toHueState__(state))
 
 
 class NewBridge(BaseModel):
@@ -245,13 +428,13 @@ class HueBody(BaseModel):
 
 
 @router.put("/config/add", responses={200: {"model": NewBridge}, 400: {"model": str}, 401: {"model": ErrorResponse}})
-def set_config(new_config: HueBody, token: str = Depends(JWTBearer())):
-    user = user_by_token(db.session, token)
+async def set_config(new_config: HueBody, context: RequestContext = Depends(request_context)):
+    user = context.user
     if user is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
 
-    bridge = crud.add_hue_bridge(
-        db.session, user.email, host=new_config.host, user=new_config.user)
+    bridge = await async_crud.add_hue_bridge(
+        context.db, user.email, host=new_config.host, user=new_config.user)
 
     if bridge is not None:
         return JSONResponse(status_code=200, content={"id": bridge.id})
@@ -264,16 +447,15 @@ class UserResponse(BaseModel):
 
 
 @router.get("/init/{bridge_id}", responses={200: {"model": UserResponse}, 400: {"model": str}, 401: {"model": ErrorResponse}})
-def hue_init(bridge_id: str, token: str = Depends(JWTBearer())):
-    user = user_by_token(db.session, token)
-    if user is None:
+async def hue_init(bridge_id: str, context: RequestContext = Depends(request_context)):
+    if context.user is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
-    bridge = crud.get_hue_bridge_by_id(db.session, user.email, bridge_id)
+    bridge = context.bridge(bridge_id)
     if bridge is None or bridge.ip == "":
         return Response(status_code=400, content="No host set")
 
-    userRequest = requests.post(
-        f"http://{bridge.ip}/api", json={"devicetype": "my_hue_app#home api"})
+    userRequest = await http_client.post(
+        bridge.ip, "/api", json={"devicetype": "my_hue_app#home api"})
 
     json = userRequest.json()[0]
     error = json.get("error")
@@ -283,48 +465,87 @@ def hue_init(bridge_id: str, token: str = Depends(JWTBearer())):
 
     user = userRequest.json()[0].get("success").get("username")
 
-    crud.update_hue_bridge(db.session, bridge._id, user=user)
+    await async_crud.update_hue_bridge(context.db, bridge._id, user=user)
 
     return JSONResponse(status_code=200, content={"username": user})
 
 
 @router.delete("/config/{bridge_id}", responses={200: {"model": str}, 401: {"model": ErrorResponse}})
-def delete_config(bridge_id: str, token: str = Depends(JWTBearer())):
-    user = user_by_token(db.session, token)
+async def delete_config(bridge_id: str, context: RequestContext = Depends(request_context)):
+    user = context.user
     if user is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
-    if crud.delete_hue_bridge_by_id(db.session, user.email, bridge_id):
+    if await async_crud.delete_hue_bridge_by_id(context.db, user.email, bridge_id):
         return Response(status_code=200)
     return Response(status_code=400)
 
 
 @router.get("/lights", response_model=dict[str, HueLightResponse])
-def get_lights(token: str = Depends(JWTBearer())):
-    return JSONResponse(status_code=200, content=LightHandler(token, db.session).__getLights__())
+async def get_lights(context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    lights = await light_handler.__getLights__()
+    return JSONResponse(status_code=200, content=lights, headers=bridge_error_headers(light_handler.errors))
 
 
 @router.get("/lights/{bridge_id}", response_model=dict[str, HueLightResponse])
-def get_lights_bridge(bridge_id: str, token: str = Depends(JWTBearer())):
-    return JSONResponse(status_code=200, content=LightHandler(token, db.session).getLightsBride(bridge_id))
+async def get_lights_bridge(bridge_id: str, context: RequestContext = Depends(request_context)):
+    return JSONResponse(status_code=200, content=await LightHandler(context).getLightsBride(bridge_id))
 
 
 @router.get("/lights/{bridge_id}/{id}", response_model=HueLightResponse)
-def get_light(bridge_id: str, id: int, token: str = Depends(JWTBearer())):
-    return JSONResponse(status_code=200, content=LightHandler(token, db.session).__getLight__(bridge_id, id))
+async def get_light(bridge_id: str, id: int, context: RequestContext = Depends(request_context)):
+    return JSONResponse(status_code=200, content=await LightHandler(context).__getLight__(bridge_id, id))
 
 
 @router.put("/lights/{bridge_id}/{id}/state", response_model=dict)
-async def set_light_state(bridge_id: str, id: int, state: HueLightState, token: str = Depends(JWTBearer())):
-    light_handler = LightHandler(token, db.session)
-    response = light_handler.__setLightState__(bridge_id, id, state)
+async def set_light_state(bridge_id: str, id: int, state: HueLightState, context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    response = await light_handler.__setLightState__(bridge_id, id, state)
 
     try:
-        light = light_handler.__getLight__(bridge_id, id)
+        light = await light_handler.__getLight__(bridge_id, id)
         if light is not None:
             await broadcast(WebSocketMessage(
                 type="light",
                 data=light,
-            ), token)
+            ), context.token)
+    except:
+        pass
+
+    if response is None:
+        return Response(status_code=400, content="No host or user set")
+
+    if response.status_code == 200:
+        return Response(status_code=200)
+
+    return Response(status_code=400, content=response.json())
+
+
+@router.get("/groups/{bridge_id}", response_model=dict[str, HueGroupResponse])
+async def get_groups(bridge_id: str, context: RequestContext = Depends(request_context)):
+    groups = await LightHandler(context).getGroupsBridge(bridge_id)
+    if groups is None:
+        return JSONResponse(status_code=404, content={"error": "Bridge not found"})
+    return JSONResponse(status_code=200, content=groups)
+
+
+@router.put("/groups/{bridge_id}/{id}/action", response_model=dict)
+async def set_group_action(bridge_id: str, id: str, state: HueLightState, context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    groups = await light_handler.getGroupsBridge(bridge_id) or {}
+    if id not in groups:
+        return JSONResponse(status_code=404, content={"error": "Group not found"})
+
+    response = await light_handler.__setGroupAction__(bridge_id, id, groups[id].get("lights", []), state)
+
+    try:
+        lights = await light_handler.getLightsBride(bridge_id) or {}
+        for light in groups[id].get("lights", []):
+            if light in lights:
+                await broadcast(WebSocketMessage(
+                    type="light",
+                    data=lights[light],
+                ), context.token)
     except:
         pass
 
@@ -338,36 +559,38 @@ async def set_light_state(bridge_id: str, id: int, state: HueLightState, token:
 
 
 @router.get("/plugs", response_model=dict[str, HuePlugResponse])
-def get_plugs(token: str = Depends(JWTBearer())):
-    return JSONResponse(status_code=200, content=LightHandler(token, db.session).__getPlugs__())
+async def get_plugs(context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    plugs = await light_handler.__getPlugs__()
+    return JSONResponse(status_code=200, content=plugs, headers=bridge_error_headers(light_handler.errors))
 
 
 @router.get("/plugs/{bridge_id}", response_model=dict[str, HuePlugResponse])
-def get_plugs_bridge(bridge_id: str, token: str = Depends(JWTBearer())):
-    return JSONResponse(status_code=200, content=LightHandler(token, db.session).getPlugsBride(bridge_id))
+async def get_plugs_bridge(bridge_id: str, context: RequestContext = Depends(request_context)):
+    return JSONResponse(status_code=200, content=await LightHandler(context).getPlugsBride(bridge_id))
 
 
 @router.get("/plugs/{bridge_id}/{id}", response_model=HuePlugResponse)
-def get_plug(bridge_id: str, id: int, token: str = Depends(JWTBearer())):
-    plug = LightHandler(token, db.session).__getPlug__(bridge_id, id)
+async def get_plug(bridge_id: str, id: int, context: RequestContext = Depends(request_context)):
+    plug = await LightHandler(context).__getPlug__(bridge_id, id)
     if plug is None:
         return Response(status_code=404, content="Plug not found")
 
-    return JSONResponse(status_code=200, content=plug.to_dict())
+    return JSONResponse(status_code=200, content=plug)
 
 
 @router.put("/plugs/{bridge_id}/{id}/state", response_model=dict)
-async def set_plug_state(bridge_id: str, id: int, state: HuePlugState, token: str = Depends(JWTBearer())):
-    light_handler = LightHandler(token, db.session)
-    response = light_handler.__setLightState__(bridge_id, id, state)
+async def set_plug_state(bridge_id: str, id: int, state: HuePlugState, context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    response = await light_handler.__setLightState__(bridge_id, id, state)
 
     try:
-        plug = light_handler.__getPlug__(bridge_id, id)
+        plug = await light_handler.__getPlug__(bridge_id, id)
         if plug is not None:
             await broadcast(WebSocketMessage(
                 type="plug",
                 data=plug,
-            ), token)
+            ), context.token)
     except:
         pass
 
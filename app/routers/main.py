@@ -1,19 +1,22 @@
+import asyncio
 from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
-from fastapi_sqlalchemy import db
-from sqlalchemy.orm import Session
-
-from ..auth_bearer import JWTBearer
-from ..consts import Light, LightState, Plug, PlugState, WebSocketMessage
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..auth_bearer import jwt_bearer
+from ..coalescer import light_coalescer
+from ..context import RequestContext, request_context
+from ..rate_limit import RateLimitExceeded, user_rate_limit
+from ..consts import Light, LightRecord, LightState, LightStateUpdate, LightsStateResponse, Plug, PlugRecord, PlugState, WebSocketMessage
+from ..serializer import JSONResponse
 from ..websocket import broadcast
-from .hue import LightHandler as HueLightHandler
+from .hue import LightHandler as HueLightHandler, bridge_error_headers, bridge_key
 from .wled import LightHandler as WledLightHandler
 
 
 router = APIRouter(
     tags=["main"],
     responses={404: {"description": "Not found"}},
-    dependencies=[Depends(JWTBearer())]
+    dependencies=[Depends(jwt_bearer), Depends(user_rate_limit)]
 )
 
 
@@ -21,48 +24,59 @@ class LightHandler:
     token: str
     hue: HueLightHandler
     wled: WledLightHandler
-    db: Session
+    db: AsyncSession
+
+    def __init__(self, context: RequestContext):
+        self.token = context.token
+        self.db = context.db
+        self.hue = HueLightHandler(context)
+        self.wled = WledLightHandler(context)
 
-    def __init__(self, token: str, db: Session):
-        self.token = token
-        self.db = db
-        self.hue = HueLightHandler(token, db)
-        self.wled = WledLightHandler(token, db)
+    async def allLights(self) -> list[LightRecord]:
+        return [*await self.hue.getLights()]
 
-    def allLights(self) -> list[Light]:
-        return [*self.hue.getLights()]
+    async def allPlugs(self) -> list[PlugRecord]:
+        return [*await self.hue.getPlugs()]
 
-    def allPlugs(self) -> list[Plug]:
-        return [*self.hue.getPlugs()]
+    # @brief Every light (Hue and WLED) and plug of the user, by device type,
+    # as the poller publishes them and websocket snapshots contain them.
+    async def allDevices(self) -> dict[str, list[LightRecord | PlugRecord]]:
+        return {
+            "light": [*await self.allLights(), *await self.wled.getLights()],
+            "plug": await self.allPlugs(),
+        }
 
-    def getLight(self, id: str):
+    async def getLight(self, id: str):
         try:
             if id.startswith("hue-"):
                 bridge_id, light_id = id.replace("hue-", "").split("-")
-                return self.hue.getLight(bridge_id, int(light_id))
-            return self.allLights()[int(id)]
+                return await self.hue.getLight(bridge_id, int(light_id))
+            return (await self.allLights())[int(id)]
         except ValueError:
             return None
         except IndexError:
             return None
 
-    def getPlug(self, id: str):
+    async def getPlug(self, id: str):
         try:
             if id.startswith("hue-"):
                 bridge_id, plug_id = id.replace("hue-", "").split("-")
-                return self.hue.getPlug(bridge_id, int(plug_id))
-            return self.allPlugs()[int(id)]
+                return await self.hue.getPlug(bridge_id, int(plug_id))
+            return (await self.allPlugs())[int(id)]
         except ValueError:
             return None
         except IndexError:
             return None
 
-    def setLightState(self, id: str, state: LightState):
+    async def setLightState(self, id: str, state: LightState):
         try:
             if id.startswith("hue-"):
                 bridge_id, light_id = id.replace("hue-", "").split("-")
-                response = self.hue.setLightState(
-                    bridge_id, int(light_id), state)
+                bridge = self.hue.context.bridge(bridge_id)
+                if bridge is None:
+                    return JSONResponse(status_code=404, content={"error": "Light not found"})
+                response = await light_coalescer.submit(
+                    bridge_key(bridge, int(light_id)), state, lambda state: self.hue.setLightState(bridge_id, int(light_id), state))
                 if response is None:
                     return JSONResponse(status_code=404, content={"error": "Light not found"})
                 return response
@@ -70,11 +84,76 @@ class LightHandler:
         except ValueError:
             return JSONResponse(status_code=404, content={"error": "Light not found"})
 
-    def setPlugState(self, id: str, state: PlugState):
+    async def __setDeviceState__(self, device: tuple[str, str], updates: list[LightStateUpdate], errors: dict[str, str]) -> list[LightRecord]:
+        type, device_id = device
+        if type == "hue":
+            responses = await self.hue.setLightsState(device_id, [
+                (int(update.id.split("-")[-1]), update.state) for update in updates
+            ])
+        updated = []
+        for update in updates:
+            if type == "hue":
+                response = responses.get(int(update.id.split("-")[-1]))
+            else:
+                response = await self.wled.setLightState(device_id, update.state)
+            if response is None:
+                errors[update.id] = "Light not found"
+            elif response.status_code != 200:
+                errors[update.id] = f"Device responded with {response.status_code}"
+            else:
+                updated.append(update.id)
+
+        if len(updated) == 0:
+            return []
+        if type == "wled":
+            light = await self.wled.getLight(device_id)
+            return [light] if light is not None else []
+
+        lights = await self.hue.getLightsBride(device_id) or {}
+        light_ids = [id.split("-")[-1] for id in updated]
+        return self.hue.__mapLights__(device_id, {
+            light_id: lights[light_id] for light_id in light_ids if light_id in lights})
+
+    # @brief Applies many light states at once.
+    #
+    # Updates are grouped per bridge / WLED device. Devices are written
+    # concurrently, the lights of one device one after another so a bridge
+    # never receives more than one command at a time from this request.
+    # Hue lights sharing a state are sent as group actions where possible.
+    async def setLightsState(self, updates: list[LightStateUpdate]) -> tuple[list[LightRecord], dict[str, str]]:
+        errors: dict[str, str] = {}
+        devices: dict[tuple[str, str], list[LightStateUpdate]] = {}
+        for update in updates:
+            if update.id.startswith("hue-"):
+                ids = update.id.replace("hue-", "").split("-")
+                if len(ids) != 2 or not ids[1].isdigit():
+                    errors[update.id] = "Light not found"
+                    continue
+                device = ("hue", ids[0])
+            else:
+                device = ("wled", update.id)
+            devices.setdefault(device, []).append(update)
+
+        results = await asyncio.gather(*(
+            self.__setDeviceState__(device, device_updates, errors) for device, device_updates in devices.items()
+        ), return_exceptions=True)
+
+        lights = []
+        for device_updates, result in zip(devices.values(), results):
+            if isinstance(result, Exception):
+                error = "Too many requests" if isinstance(
+                    result, RateLimitExceeded) else "Device not reachable"
+                for update in device_updates:
+                    errors.setdefault(update.id, error)
+                continue
+            lights.extend(result)
+        return lights, errors
+
+    async def setPlugState(self, id: str, state: PlugState):
         try:
             if id.startswith("hue-"):
                 bridge_id, plug_id = id.replace("hue-", "").split("-")
-                response = self.hue.setLightState(
+                response = await self.hue.setLightState(
                     bridge_id, int(plug_id), state)
                 if response is None:
                     return JSONResponse(status_code=404, content={"error": "Plug not found"})
@@ -85,29 +164,44 @@ class LightHandler:
 
 
 @router.get("/lights", response_model=list[Light])
-def get_lights(token: str = Depends(JWTBearer())):
-    lights = []
-    for light in LightHandler(token, db.session).allLights():
-        lights.append(light.to_dict())
+async def get_lights(context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    lights = await light_handler.allLights()
 
-    return JSONResponse(status_code=200, content=lights)
+    return JSONResponse(status_code=200, content=lights, headers=bridge_error_headers(light_handler.hue.errors))
 
 
 @router.get("/lights/{id}", response_model=Light)
-def get_light(id: str, token: str = Depends(JWTBearer())):
-    light = LightHandler(token, db.session).getLight(id)
+async def get_light(id: str, context: RequestContext = Depends(request_context)):
+    light = await LightHandler(context).getLight(id)
 
     if light is None:
         return JSONResponse(status_code=404, content={"error": "Light not found"})
-    return JSONResponse(status_code=200, content=light.to_dict())
+    return JSONResponse(status_code=200, content=light)
+
+
+@router.put("/lights/state", response_model=LightsStateResponse)
+async def set_lights_state(updates: list[LightStateUpdate], context: RequestContext = Depends(request_context)):
+    lights, errors = await LightHandler(context).setLightsState(updates)
+
+    if len(lights) > 0:
+        try:
+            await broadcast(WebSocketMessage(
+                type="lights",
+                data={"lights": lights},
+            ), context.token)
+        except:
+            pass
+
+    return JSONResponse(status_code=200, content={"lights": lights, "errors": errors})
 
 
 @router.put("/lights/{id}/state", response_model=dict)
-async def set_light_state(id: str, state: LightState, token: str = Depends(JWTBearer())):
-    light_handler = LightHandler(token, db.session)
-    response = light_handler.setLightState(id, state)
+async def set_light_state(id: str, state: LightState, context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    response = await light_handler.setLightState(id, state)
 
-    light = light_handler.getLight(id)
+    light = await light_handler.getLight(id)
 
     if light is None:
         return JSONResponse(status_code=404, content={"error": "Light not found"})
@@ -115,41 +209,40 @@ async def set_light_state(id: str, state: LightState, token: str = Depends(JWTBe
     try:
         await broadcast(WebSocketMessage.from_dict({
             "type": "light",
-            "data": light.__dict__,
-        }), token)
+            "data": light.to_dict(),
+        }), context.token)
     except:
         pass
 
     if response.status_code == 200:
-        return JSONResponse(status_code=200, content=light.to_dict())
+        return JSONResponse(status_code=200, content=light)
 
     return response
 
 
 @router.get("/plugs", response_model=list[Plug])
-def get_plugs(token: str = Depends(JWTBearer())):
-    plugs = []
-    for plug in LightHandler(token, db.session).allPlugs():
-        plugs.append(plug.to_dict())
+async def get_plugs(context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    plugs = await light_handler.allPlugs()
 
-    return JSONResponse(status_code=200, content=plugs)
+    return JSONResponse(status_code=200, content=plugs, headers=bridge_error_headers(light_handler.hue.errors))
 
 
 @router.get("/plugs/{id}", response_model=Plug)
-def get_plug(id: str, token: str = Depends(JWTBearer())):
-    plug = LightHandler(token, db.session).getPlug(id)
+async def get_plug(id: str, context: RequestContext = Depends(request_context)):
+    plug = await LightHandler(context).getPlug(id)
 
     if plug is None:
         return JSONResponse(status_code=404, content={"error": "Plug not found"})
-    return JSONResponse(status_code=200, content=plug.to_dict())
+    return JSONResponse(status_code=200, content=plug)
 
 
 @router.put("/plugs/{id}/state", response_model=dict)
-async def set_plug_state(id: str, state: PlugState, token: str = Depends(JWTBearer())):
-    light_handler = LightHandler(token, db.session)
-    response = light_handler.setPlugState(id, state)
+async def set_plug_state(id: str, state: PlugState, context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    response = await light_handler.setPlugState(id, state)
 
-    plug = light_handler.getPlug(id)
+    plug = await light_handler.getPlug(id)
 
     if plug is None:
         return JSONResponse(status_code=404, content={"error": "Plug not found"})
@@ -157,12 +250,12 @@ async def set_plug_state(id: str, state: PlugState, token: str = Depends(JWTBear
     try:
         await broadcast(WebSocketMessage(
             type="plug",
-            data=plug.__dict__,
-        ), token)
+            data=plug.to_dict(),
+        ), context.token)
     except:
         pass
 
     if response.status_code == 200:
-        return JSONResponse(status_code=200, content=plug.to_dict())
+        return JSONResponse(status_code=200, content=plug)
 
     return response
@@ -1,21 +1,23 @@
-from typing import Optional
+import asyncio
 from urllib.parse import unquote
 from fastapi import APIRouter, Depends, Response
-import requests
-from fastapi.responses import JSONResponse
-from fastapi_sqlalchemy import db
-from sqlalchemy.orm import Session
-
-from ..auth_handler import decodeJWT
-from ..model import UserSchema
-from ..sql_app import crud
-from ..auth_bearer import JWTBearer
-from ..consts import ErrorResponse, Light, LightState, Wled, WledItem, WledState
+import httpx
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..sql_app import async_crud
+from .. import color
+from ..auth_bearer import jwt_bearer
+from ..context import RequestContext, request_context
+from ..rate_limit import RateLimitExceeded, user_rate_limit
+from ..consts import WLED_CONCURRENCY, WLED_TIMEOUT, ErrorResponse, LightRecord, LightState, Wled, WledItem, WledState
+from ..http_client import http_client
+from ..cache import device_cache
+from ..serializer import JSONResponse
 
 router = APIRouter(
     tags=["wled"],
     responses={404: {"description": "Not found"}},
-    dependencies=[Depends(JWTBearer())]
+    dependencies=[Depends(jwt_bearer), Depends(user_rate_limit)]
 )
 
 
@@ -24,33 +26,34 @@ class WledReponseState(Wled):
     name: str
 
 
-def user_by_token(db: Session, token: str) -> Optional[UserSchema]:
-    email = (decodeJWT(token) or {}).get("email")
-    return crud.get_user_by_email(db, email) if email else None
+def wled_key(ip: str) -> tuple:
+    return ("wled", ip)
 
 
 class LightHandler:
     token: str
-    db: Session
-
-    def __init__(self, token: str, db: Session):
-        self.token = token
-        self.db = db
-
-    def __user_by_token__(self):
-        return user_by_token(self.db, self.token)
+    db: AsyncSession
+    context: RequestContext
+    errors: dict[str, str]
+    max_age: float | None
+
+    def __init__(self, context: RequestContext):
+        self.token = context.token
+        self.db = context.db
+        self.context = context
+        self.errors = {}
+        self.max_age = None
 
     def __config_by_token__(self):
-        user = user_by_token(self.db, self.token)
-        return user.settings if user else None
+        return self.context.settings
 
-    def __map_light__(self, light: WledReponseState) -> Light:
-        colors = []
+    def __map_light__(self, light: WledReponseState) -> LightRecord:
+        colors = ()
         if light.state is not None and light.state.seg is not None:
-            for seg in light.state.seg:
-                colors.append((seg.col[0], seg.col[1], seg.col[2]))
+            colors = tuple(tuple(rgb) for rgb in color.segment_colors(
+                [seg.col[0] for seg in light.state.seg if len(seg.col) > 0]).tolist())
 
-        return Light(
+        return LightRecord(
             id=light.ip,
             name=light.name,
             on=light.state.on is True,
@@ -66,39 +69,57 @@ class LightHandler:
         )
 
     async def __allLights__(self) -> list[WledReponseState]:
-        lights = []
         config = self.__config_by_token__()
         if config is None:
-            return lights
-        for light in config.wled_ips:
-            lightResponse = self.__getLight__(light.ip)
-            if lightResponse is not None:
-                lights.append(lightResponse)
+            return []
+        semaphore = asyncio.Semaphore(WLED_CONCURRENCY)
 
-        return lights
+        async def fetch(wled: WledItem):
+            async with semaphore:
+                return await self.__fetchLight__(wled.ip, wled.name)
 
-    def __getLight__(self, ip: str) -> WledReponseState | None:
-        user = self.__user_by_token__()
-        if user is None:
-            return None
-        wled = crud.get_wled(self.db, user.email, ip)
-        if wled is None:
-            return None
+        lights = await asyncio.gather(*(fetch(wled) for wled in config.wled_ips))
+        return [light for light in lights if light is not None]
 
-        try:
-            response = requests.get(f"http://{ip}/json")
+    async def __fetchLight__(self, ip: str, name: str) -> WledReponseState | None:
+        async def fetch():
+            response = await http_client.get(ip, "/json")
+            return response.json()
 
-            data: dict = response.json()
-            data.update({
+        try:
+            data: dict = await asyncio.wait_for(device_cache.fetch(wled_key(ip), fetch, self.max_age), WLED_TIMEOUT)
+            return WledReponseState.from_dict({
+                **data,
                 "ip": ip,
-                "name": wled.name,
+                "name": name,
             })
-            return WledReponseState.from_dict(data)
-        except:
+        except asyncio.TimeoutError:
+            self.errors[ip] = "timeout"
+        except RateLimitExceeded:
+            self.errors[ip] = "rate_limited"
+        except (httpx.HTTPError, ValueError):
+            self.errors[ip] = "unreachable"
+        return None
+
+    async def __getLight__(self, ip: str) -> WledReponseState | None:
+        wled = self.context.wled(ip)
+        if wled is None:
             return None
+        return await self.__fetchLight__(ip, wled.name)
 
-    def __setLightState__(self, ip: str, state: WledState):
-        return requests.post(f"http://{ip}/json/state", json=state.to_dict())
+    async def __setLightState__(self, ip: str, state: WledState):
+        # "v" makes WLED answer with the full new state, so it doesn't have to be read back
+        response = await http_client.post(ip, "/json/state", json={**state.to_dict(), "v": True})
+        cached = device_cache.get(wled_key(ip), device_cache.ttl)
+        try:
+            new_state = response.json() if response.status_code == 200 else None
+        except ValueError:
+            new_state = None
+        if cached is not None and isinstance(new_state, dict) and "on" in new_state:
+            device_cache.set(wled_key(ip), {**cached, "state": new_state})
+        else:
+            device_cache.invalidate(wled_key(ip))
+        return response
 
     async def getLights(self):
         lights = []
@@ -106,59 +127,59 @@ class LightHandler:
             lights.append(self.__map_light__(light))
         return lights
 
-    def getLight(self, id: str):
-        light = self.__getLight__(id)
+    async def getLight(self, id: str):
+        light = await self.__getLight__(id)
         if light is None:
             return None
         return self.__map_light__(light)
 
-    def setLightState(self, id: str, state: LightState):
-        light = self.__getLight__(id)
+    async def setLightState(self, id: str, state: LightState):
+        light = await self.__getLight__(id)
         if light is None:
             return None
         new_state = {}
         if state.color is not None:
             new_state["seg"] = []
-            for color in state.color:
+            for rgb in state.color:
                 new_state["seg"].append({
-                    "col": [color[0], color[1], color[2]]
+                    "col": [rgb[0], rgb[1], rgb[2]]
                 })
         if state.on is not None:
             new_state["on"] = state.on
         if state.brightness is not None:
             new_state["bri"] = state.brightness
-        return self.__setLightState__(id, WledState.from_dict(new_state))
+        return await self.__setLightState__(id, WledState.from_dict(new_state))
 
 
 @router.put("/devices/add", responses={401: {"model": ErrorResponse}, 200: {"model": str}})
-async def add_device(item: WledItem, token: str = Depends(JWTBearer())):
-    user = user_by_token(db.session, token)
+async def add_device(item: WledItem, context: RequestContext = Depends(request_context)):
+    user = context.user
     if user is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
-    crud.add_wled(db.session, user.email, ip=item.ip, name=item.name)
+    await async_crud.add_wled(context.db, user.email, ip=item.ip, name=item.name)
     return Response(status_code=200)
 
 
 @router.delete("/devices/remove/{ip}", responses={401: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 200: {"model": str}})
-async def remove_device(ip: str, token: str = Depends(JWTBearer())):
-    user = user_by_token(db.session, token)
+async def remove_device(ip: str, context: RequestContext = Depends(request_context)):
+    user = context.user
     if user is None:
         return JSONResponse(status_code=401, content={"error": "Invalid token"})
-    if crud.delete_wled(db.session, user.email, unquote(ip)):
+    if await async_crud.delete_wled(context.db, user.email, unquote(ip)):
         return Response(status_code=200)
     return JSONResponse(status_code=404, content={"error": "Light not found"})
 
 
 @router.get("/lights", response_model=list[WledReponseState])
-async def lights(token: str = Depends(JWTBearer())):
-    lights = await LightHandler(token, db.session).__allLights__()
+async def lights(context: RequestContext = Depends(request_context)):
+    lights = await LightHandler(context).__allLights__()
 
     return JSONResponse(status_code=200, content=lights)
 
 
 @router.get("/lights/{ip}", responses={401: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 200: {"model": WledReponseState}})
-async def light(ip: str, token: str = Depends(JWTBearer())):
-    light = LightHandler(token, db.session).__getLight__(ip)
+async def light(ip: str, context: RequestContext = Depends(request_context)):
+    light = await LightHandler(context).__getLight__(ip)
 
     if light is None:
         return JSONResponse(status_code=404, content={"error": "Light not found"})
@@ -166,11 +187,11 @@ async def light(ip: str, token: str = Depends(JWTBearer())):
 
 
 @router.put("/lights/{ip}/state", responses={401: {"model": ErrorResponse}, 404: {"model": ErrorResponse}, 200: {"model": WledReponseState}})
-async def light_state(ip: str, state: WledState, token: str = Depends(JWTBearer())):
-    light_handler = LightHandler(token, db.session)
-    response = light_handler.__setLightState__(ip, state)
+async def light_state(ip: str, state: WledState, context: RequestContext = Depends(request_context)):
+    light_handler = LightHandler(context)
+    response = await light_handler.__setLightState__(ip, state)
 
-    light = light_handler.__getLight__(ip)
+    light = await light_handler.__getLight__(ip)
 
     if light is None:
         return JSONResponse(status_code=404, content={"error": "Light not found"})
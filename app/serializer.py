@@ -0,0 +1,71 @@
+from dataclasses import fields, is_dataclass
+from typing import Any, Callable
+import orjson
+from fastapi.responses import JSONResponse as StarletteJSONResponse
+from pydantic import BaseModel
+
+OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATACLASS
+
+__fields__: dict[type, tuple[str, ...]] = {}
+
+
+# @brief Field names of a model or dataclass, looked up once per class.
+def fields_of(cls: type) -> tuple[str, ...]:
+    names = __fields__.get(cls)
+    if names is None:
+        if issubclass(cls, BaseModel):
+            names = tuple(cls.__fields__)
+        else:
+            names = tuple(field.name for field in fields(cls))
+        __fields__[cls] = names
+    return names
+
+
+def is_model(value: Any) -> bool:
+    return isinstance(value, BaseModel) or (is_dataclass(value) and not isinstance(value, type))
+
+
+# @brief Shallow dict of a model or dataclass without its None fields. Nested
+# models are left as they are, orjson calls back into this for them.
+def __model_dict__(model: Any) -> dict:
+    result = {}
+    for name in fields_of(type(model)):
+        value = getattr(model, name)
+        if value is not None:
+            result[name] = value
+    return result
+
+
+def __default__(value: Any):
+    if is_model(value):
+        return __model_dict__(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+# @brief Recursively copies models, dataclasses and the lists/tuples/dicts
+# holding them into plain dicts without None fields. The input is never
+# modified.
+def to_primitive(value: Any) -> Any:
+    if is_model(value):
+        return {name: to_primitive(field) for name, field in __model_dict__(value).items()}
+    if isinstance(value, dict):
+        return {key: to_primitive(field) for key, field in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_primitive(item) for item in value]
+    return value
+
+
+# @brief Encodes models, dicts and lists straight to JSON bytes.
+def dumps(value: Any) -> bytes:
+    return orjson.dumps(value, default=__default__, option=OPTIONS)
+
+
+loads: Callable[[bytes | str], Any] = orjson.loads
+
+
+# @brief JSONResponse that accepts models directly and renders them with orjson.
+class JSONResponse(StarletteJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
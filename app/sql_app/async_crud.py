@@ -0,0 +1,240 @@
+from typing import Optional, Sequence
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload, selectinload
+
+from ..auth_handler import hash_password, verified_tokens
+from ..model import UserSchema
+
+from . import models
+
+
+# Relationships are never loaded lazily on an AsyncSession, so every query
+# loads what its callers touch.
+
+
+def __with_settings__():
+    return (
+        joinedload(models.User.settings).joinedload(
+            models.UserSettings.hue_bridges),
+        joinedload(models.User.settings).joinedload(
+            models.UserSettings.wled_ips),
+    )
+
+
+async def get_user_by_id(db: AsyncSession, user_id: int) -> models.User | None:
+    return (await db.scalars(select(models.User).where(
+        models.User.id == user_id))).one_or_none()
+
+
+async def get_user_by_username(db: AsyncSession, username: str) -> models.User | None:
+    return (await db.scalars(select(models.User).where(
+        models.User.username == username))).one_or_none()
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> models.User | None:
+    return (await db.scalars(select(models.User).where(
+        models.User.email == email))).one_or_none()
+
+
+async def get_user_with_settings_by_email(db: AsyncSession, email: str) -> models.User | None:
+    return (await db.scalars(select(models.User).where(models.User.email == email).options(
+        *__with_settings__()
+    ))).unique().one_or_none()
+
+
+async def get_users_with_settings(db: AsyncSession, skip: int = 0, limit: int = 100) -> Sequence[models.User]:
+    return (await db.scalars(select(models.User).order_by(models.User.id).offset(skip).limit(limit).options(
+        *__with_settings__()
+    ))).unique().all()
+
+
+async def get_users(db: AsyncSession, skip: int = 0, limit: int = 100) -> Sequence[models.User]:
+    return (await db.scalars(select(models.User).offset(skip).limit(limit))).all()
+
+
+async def create_user(db: AsyncSession, user: UserSchema, hashed_password: Optional[str] = None) -> models.User | None:
+    await db.execute(insert(models.User), [
+        {
+            "username": user.username,
+            "email": user.email,
+            "hashed_password": hashed_password if hashed_password is not None else hash_password(user.password),
+            "settings": models.UserSettings(
+                hue_index=0,
+            ) if user.settings is None else models.UserSettings(**{
+                "hue_index": user.settings.hue_index,
+                "hue_bridges": [models.HueBridge(**{
+                    "id": bridge.id,
+                    "ip": bridge.ip,
+                    "user": bridge.user,
+                }) for bridge in user.settings.hue_bridges],
+                "wled_ips": [models.WledItem(**{
+                    "ip": wled.ip,
+                    "name": wled.name,
+                }) for wled in user.settings.wled_ips],
+            }),
+        }
+    ])
+    await db.commit()
+    return await get_user_by_email(db, user.email)
+
+
+async def delete_user_by_email(db: AsyncSession, email: str) -> bool:
+    user = (await db.scalars(select(models.User).where(
+        models.User.email == email).options(selectinload(models.User.settings)))).one_or_none()
+    if user is None:
+        return False
+    await db.delete(user)
+    await db.commit()
+    verified_tokens.invalidate_email(email)
+    return True
+
+
+async def update_user_by_email(db: AsyncSession, email: str, new_user: UserSchema) -> UserSchema | None:
+    db_user = (await db.scalars(select(models.User).where(
+        models.User.email == email))).one_or_none()
+    if db_user is None:
+        return None
+    for key, value in new_user.dict().items():
+        setattr(db_user, key, value)
+    await db.commit()
+    verified_tokens.invalidate_email(email)
+    await db.refresh(db_user)
+    return UserSchema(**db_user.__dict__)
+
+
+async def update_user_hashed_password(db: AsyncSession, email: str, hashed_password: str) -> bool:
+    db_user = await get_user_by_email(db, email)
+    if db_user is None:
+        return False
+    db_user.hashed_password = hashed_password
+    await db.commit()
+    return True
+
+
+async def get_user_settings_by_email(db: AsyncSession, email: str) -> models.UserSettings | None:
+    user = await get_user_with_settings_by_email(db, email)
+    if user is None:
+        return None
+
+    if user.settings is None:
+        user.settings = models.UserSettings(
+            hue_index=0, hue_bridges=[], wled_ips=[])
+        await db.commit()
+    return user.settings
+
+
+async def add_hue_bridge(db: AsyncSession, email: str, host: Optional[str] = None, user: Optional[str] = None) -> models.HueBridge | None:
+    user_settings = await get_user_settings_by_email(db, email)
+    if user_settings is None:
+        return None
+
+    user_settings.hue_index += 1
+    bridge = models.HueBridge(
+        id=str(user_settings.hue_index),
+        ip="",
+        user="",
+    )
+    if host is not None:
+        bridge.ip = host
+    if user is not None:
+        bridge.user = user
+
+    user_settings.hue_bridges.append(bridge)
+    await db.commit()
+    await db.refresh(bridge)
+    return bridge
+
+
+async def get_hue_bridge_by_id(db: AsyncSession, email: str, bridge_id: str) -> models.HueBridge | None:
+    user_settings = await get_user_settings_by_email(db, email)
+    if user_settings is None:
+        return None
+
+    return next((bridge for bridge in user_settings.hue_bridges if bridge.id == bridge_id), None)
+
+
+async def get_hue_bridges_with_user_id(db: AsyncSession) -> Sequence[tuple[models.HueBridge, int]]:
+    return (await db.execute(
+        select(models.HueBridge, models.User.id)
+        .join(models.UserSettings, models.HueBridge.user_settings_id == models.UserSettings.id)
+        .join(models.User, models.UserSettings.user_id == models.User.id)
+        .where(models.HueBridge.ip != "", models.HueBridge.user != "")
+    )).tuples().all()
+
+
+async def update_hue_bridge(db: AsyncSession, bridge_db_id: int, ip: Optional[str] = None, user: Optional[str] = None) -> models.HueBridge | None:
+    bridge = (await db.scalars(select(models.HueBridge).where(
+        models.HueBridge._id == bridge_db_id))).one_or_none()
+    if bridge is None:
+        return None
+    if ip is not None:
+        setattr(bridge, "ip", ip)
+    if user is not None:
+        setattr(bridge, "user", user)
+    await db.commit()
+    await db.refresh(bridge)
+    return bridge
+
+
+async def delete_hue_bridge(db: AsyncSession, bridge_db_id: int) -> bool:
+    bridge = (await db.scalars(select(models.HueBridge).where(
+        models.HueBridge._id == bridge_db_id))).one_or_none()
+    if bridge is None:
+        return False
+    await db.delete(bridge)
+    await db.commit()
+    return True
+
+
+async def delete_hue_bridge_by_id(db: AsyncSession, email: str, bridge_id: str) -> bool:
+    bridge = await get_hue_bridge_by_id(db, email, bridge_id)
+    if bridge is None:
+        return False
+    await db.delete(bridge)
+    await db.commit()
+    return True
+
+
+async def get_wled(db: AsyncSession, email: str, ip: str) -> models.WledItem | None:
+    user_settings = await get_user_settings_by_email(db, email)
+    if user_settings is None:
+        return None
+
+    return next((wled for wled in user_settings.wled_ips if wled.ip == ip), None)
+
+
+async def add_wled(db: AsyncSession, email: str, ip: str, name: Optional[str] = None) -> models.WledItem | None:
+    user_settings = await get_user_settings_by_email(db, email)
+    if user_settings is None:
+        return None
+
+    wled = models.WledItem()
+    wled.ip = ip
+    if name is not None:
+        wled.name = name
+
+    user_settings.wled_ips.append(wled)
+    await db.commit()
+    await db.refresh(wled)
+    return wled
+
+
+async def update_wled(db: AsyncSession, email: str, ip: str, name: Optional[str] = None) -> models.WledItem | None:
+    wled = await get_wled(db, email, ip)
+    if wled is None:
+        return None
+    if name is not None:
+        setattr(wled, "name", name)
+    await db.commit()
+    await db.refresh(wled)
+    return wled
+
+
+async def delete_wled(db: AsyncSession, email: str, ip: str) -> bool:
+    wled = await get_wled(db, email, ip)
+    if wled is None:
+        return False
+    await db.delete(wled)
+    await db.commit()
+    return True
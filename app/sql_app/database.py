@@ -1,19 +1,111 @@
-from sqlalchemy import create_engine
+from typing import AsyncIterator
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-from ..consts import SQLALCHEMY_DATABASE_URL
+from ..consts import DATABASE_MAX_OVERFLOW, DATABASE_POOL_PRE_PING, DATABASE_POOL_RECYCLE, DATABASE_POOL_SIZE, DATABASE_POOL_TIMEOUT, DATABASE_READ_URL, SQLALCHEMY_DATABASE_URL, SQLITE_BUSY_TIMEOUT, SQLITE_JOURNAL_MODE, SQLITE_MMAP_SIZE, SQLITE_SYNCHRONOUS
 
 
-connect_args = {}
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+}
 
-if SQLALCHEMY_DATABASE_URL.startswith("sqlite"):
-    connect_args["check_same_thread"] = False
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args=connect_args
-)
+# @brief The configured database url with its async driver, e.g. sqlite://
+# becomes sqlite+aiosqlite:// and postgresql:// becomes postgresql+asyncpg://.
+def async_database_url(url: str) -> str:
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None or parsed.drivername == driver:
+        return url
+    return parsed.set(drivername=driver).render_as_string(hide_password=False)
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+
+# @brief Pool settings for `url`. In-memory SQLite databases live in a single
+# connection and keep SQLAlchemy's static pool.
+def engine_options(url: str) -> dict:
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return {}
+    return {
+        "pool_size": DATABASE_POOL_SIZE,
+        "max_overflow": DATABASE_MAX_OVERFLOW,
+        "pool_timeout": DATABASE_POOL_TIMEOUT,
+        "pool_recycle": DATABASE_POOL_RECYCLE,
+        "pool_pre_ping": DATABASE_POOL_PRE_PING,
+    }
+
+
+# @brief Sets the SQLite pragmas on every new connection of `engine`.
+#
+# In WAL mode readers no longer block on a writer and a commit only appends
+# to the log, which synchronous=NORMAL syncs at checkpoints instead of on
+# every commit. Writers still take turns, they wait up to SQLITE_BUSY_TIMEOUT
+# seconds for each other instead of failing with "database is locked".
+def sqlite_pragmas(engine: Engine, read_only: bool = False):
+    pragmas = [
+        f"journal_mode={SQLITE_JOURNAL_MODE}",
+        f"synchronous={SQLITE_SYNCHRONOUS}",
+        f"mmap_size={SQLITE_MMAP_SIZE}",
+        f"busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}",
+    ]
+    if read_only:
+        pragmas.append("query_only=ON")
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(f"PRAGMA {pragma}")
+        cursor.close()
+
+
+def build_engine(url: str, read_only: bool = False) -> Engine:
+    connect_args = {}
+    if is_sqlite(url):
+        connect_args["check_same_thread"] = False
+    engine = create_engine(
+        url, connect_args=connect_args, **engine_options(url))
+    if is_sqlite(url):
+        sqlite_pragmas(engine, read_only)
+    return engine
+
+
+def build_async_engine(url: str, read_only: bool = False):
+    url = async_database_url(url)
+    engine = create_async_engine(url, **engine_options(url))
+    if is_sqlite(url):
+        sqlite_pragmas(engine.sync_engine, read_only)
+    return engine
+
+
+# sync engine, only used by main.py to create the schema
+engine = build_engine(SQLALCHEMY_DATABASE_URL)
+
+# async engines, used by the routes, the websocket and the background jobs.
+# Queries that only read go to `async_read_engine`, which is a separate pool
+# (e.g. on a replica) when DATABASE_READ_URL is set.
+async_engine = build_async_engine(SQLALCHEMY_DATABASE_URL)
+async_read_engine = build_async_engine(
+    DATABASE_READ_URL, read_only=True) if DATABASE_READ_URL else async_engine
+
+# objects stay usable after a commit, loading them again would need a query
+# outside of the session
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(
+    async_read_engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
+
+
+async def async_session() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as session:
+        yield session
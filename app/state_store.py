@@ -0,0 +1,204 @@
+import numpy as np
+
+from .consts import LightRecord, PlugRecord
+
+Record = LightRecord | PlugRecord
+
+# numeric state columns, compared and queried in bulk
+COLUMNS: dict[str, type] = {
+    "on": np.bool_,
+    "reachable": np.bool_,
+    "brightness": np.float64,
+    "red": np.int16,
+    "green": np.int16,
+    "blue": np.int16,
+    "meta": np.int64,
+    "owner": np.int32,
+    "kind": np.int32,
+    "source": np.int32,
+}
+
+# columns holding codes of the strings they stand for
+CATEGORIES = ("owner", "kind", "source")
+
+
+# @brief Bridge (or WLED device) a normalized device belongs to, "hue-1-4"
+# belongs to "hue-1" and a WLED light is its own source.
+def source_of(id: str) -> str:
+    if id.startswith("hue-"):
+        return id.rsplit("-", 1)[0]
+    return id
+
+
+# @brief Hash of the descriptive fields that don't have a column of their own,
+# so renames or extra segment colours still show up as changes.
+def meta_of(record: Record) -> int:
+    return hash((record.name, record.type, record.model, record.manufacturer,
+                 record.uniqueid, record.swversion, record.productid,
+                 getattr(record, "color", ())[1:]))
+
+
+# @brief Columnar store of the normalized device state of every user.
+#
+# Each device (owner, kind, id) owns one row of a set of numpy columns, found
+# through an id -> row index. Updating a whole poll result is one vectorized
+# compare per column, and queries like "all unreachable" or "all on in bridge
+# X" are boolean masks instead of walks over nested dicts. The last record of
+# every row is kept next to the columns so changed rows can be sent as they
+# are.
+class DeviceStateStore:
+    def __init__(self, capacity: int = 256):
+        self.__index__: dict[tuple[int, str, str], int] = {}
+        # ids per (owner, kind), so pruning one user doesn't walk every device
+        self.__ids__: dict[tuple[int, str], set[str]] = {}
+        self.__free__: list[int] = []
+        self.__seen__: set[tuple[int, str]] = set()
+        self.__codes__: dict[str, dict[int | str, int]] = {
+            name: {} for name in CATEGORIES}
+        self.__size__ = 0
+        self.__alive__ = np.zeros(capacity, dtype=np.bool_)
+        self.__records__ = np.empty(capacity, dtype=object)
+        self.__columns__ = {name: np.zeros(capacity, dtype=dtype)
+                            for name, dtype in COLUMNS.items()}
+
+    def __len__(self) -> int:
+        return len(self.__index__)
+
+    def __code__(self, category: str, value: int | str) -> int:
+        codes = self.__codes__[category]
+        code = codes.get(value)
+        if code is None:
+            code = len(codes)
+            codes[value] = code
+        return code
+
+    def __grow__(self, needed: int):
+        capacity = len(self.__alive__)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        extra = capacity - len(self.__alive__)
+        self.__alive__ = np.concatenate(
+            [self.__alive__, np.zeros(extra, dtype=np.bool_)])
+        self.__records__ = np.concatenate(
+            [self.__records__, np.empty(extra, dtype=object)])
+        for name, column in self.__columns__.items():
+            self.__columns__[name] = np.concatenate(
+                [column, np.zeros(extra, dtype=column.dtype)])
+
+    # @brief Rows of the given keys, allocating rows for unknown keys. The
+    # second array flags the newly allocated ones.
+    def __rows__(self, keys: list[tuple[int, str, str]]) -> tuple[np.ndarray, np.ndarray]:
+        rows = np.empty(len(keys), dtype=np.int64)
+        new = np.zeros(len(keys), dtype=np.bool_)
+        missing = sum(1 for key in keys if key not in self.__index__)
+        self.__grow__(self.__size__ + max(0, missing - len(self.__free__)))
+        for position, key in enumerate(keys):
+            row = self.__index__.get(key)
+            if row is None:
+                if len(self.__free__) > 0:
+                    row = self.__free__.pop()
+                else:
+                    row = self.__size__
+                    self.__size__ += 1
+                self.__index__[key] = row
+                self.__ids__.setdefault(key[:2], set()).add(key[2])
+                self.__alive__[row] = True
+                new[position] = True
+            rows[position] = row
+        return rows, new
+
+    def __values__(self, owner: int, kind: str, records: list[Record]) -> dict[str, np.ndarray]:
+        count = len(records)
+        colors = np.array([record.color[0] if len(getattr(record, "color", ())) > 0 else (-1, -1, -1)
+                           for record in records], dtype=np.int16).reshape(count, 3)
+        return {
+            "on": np.fromiter((record.on for record in records), dtype=np.bool_, count=count),
+            "reachable": np.fromiter((record.reachable for record in records), dtype=np.bool_, count=count),
+            "brightness": np.fromiter((getattr(record, "brightness", 0) for record in records), dtype=np.float64, count=count),
+            "red": colors[:, 0],
+            "green": colors[:, 1],
+            "blue": colors[:, 2],
+            "meta": np.fromiter((meta_of(record) for record in records), dtype=np.int64, count=count),
+            "owner": np.full(count, self.__code__("owner", owner), dtype=np.int32),
+            "kind": np.full(count, self.__code__("kind", kind), dtype=np.int32),
+            "source": np.fromiter((self.__code__("source", source_of(record.id)) for record in records), dtype=np.int32, count=count),
+        }
+
+    # @brief Whether `update` has been called for this owner and kind before.
+    def has(self, owner: int, kind: str) -> bool:
+        return (owner, kind) in self.__seen__
+
+    # @brief Writes one poll result and returns the records that are new or
+    # differ from what the store held before.
+    def update(self, owner: int, kind: str, records: list[Record]) -> list[Record]:
+        self.__seen__.add((owner, kind))
+        if len(records) == 0:
+            return []
+        rows, changed = self.__rows__(
+            [(owner, kind, record.id) for record in records])
+        for name, values in self.__values__(owner, kind, records).items():
+            column = self.__columns__[name]
+            changed |= column[rows] != values
+            column[rows] = values
+        stored = np.empty(len(records), dtype=object)
+        stored[:] = records
+        self.__records__[rows] = stored
+        return [records[position] for position in np.flatnonzero(changed)]
+
+    def remove(self, owner: int, kind: str, ids: list[str]):
+        stored = self.__ids__.get((owner, kind), set())
+        for id in ids:
+            row = self.__index__.pop((owner, kind, id), None)
+            if row is None:
+                continue
+            stored.discard(id)
+            self.__alive__[row] = False
+            self.__records__[row] = None
+            self.__free__.append(row)
+        if len(stored) == 0:
+            self.__ids__.pop((owner, kind), None)
+
+    # @brief Removes the devices of this owner and kind that are not in `ids`,
+    # i.e. that a complete poll no longer reported, and returns their ids.
+    def prune(self, owner: int, kind: str, ids: set[str]) -> list[str]:
+        gone = [id for id in self.__ids__.get((owner, kind), ())
+                if id not in ids]
+        self.remove(owner, kind, gone)
+        return gone
+
+    def owners(self) -> set[int]:
+        return {owner for owner, _ in self.__seen__}
+
+    # @brief Forgets everything stored for `owner`, e.g. a deleted user.
+    def remove_owner(self, owner: int):
+        for kind in [kind for seen_owner, kind in self.__seen__ if seen_owner == owner]:
+            self.prune(owner, kind, set())
+            self.__seen__.discard((owner, kind))
+
+    # @brief Boolean row mask of the devices matching all given filters.
+    def mask(self, owner: int | None = None, kind: str | None = None, source: str | None = None,
+             on: bool | None = None, reachable: bool | None = None) -> np.ndarray:
+        mask = self.__alive__[:self.__size__].copy()
+        for category, value in (("owner", owner), ("kind", kind), ("source", source)):
+            if value is None:
+                continue
+            code = self.__codes__[category].get(value)
+            if code is None:
+                return np.zeros(self.__size__, dtype=np.bool_)
+            mask &= self.__columns__[category][:self.__size__] == code
+        for name, value in (("on", on), ("reachable", reachable)):
+            if value is not None:
+                mask &= self.__columns__[name][:self.__size__] == value
+        return mask
+
+    # @brief Last known records of the devices matching all given filters.
+    def query(self, **filters) -> list[Record]:
+        return self.__records__[:self.__size__][self.mask(**filters)].tolist()
+
+    def count(self, **filters) -> int:
+        return int(self.mask(**filters).sum())
+
+
+device_states = DeviceStateStore()
@@ -1,66 +1,346 @@
-
-from json import dumps, loads
+import asyncio
+from collections import deque
+import logging
+from typing import Awaitable, Callable
 from fastapi import WebSocket
 
-
-from .sql_app import crud
-from .sql_app.database import SessionLocal
-from .auth_bearer import JWTBearer
+from .sql_app import async_crud
+from .sql_app.database import AsyncReadSessionLocal
+from .auth_bearer import jwt_bearer
 from .auth_handler import decodeJWT
-from .consts import WebSocketMessage
+from .consts import WS_SEND_QUEUE, WS_SEND_TIMEOUT, WS_SLOW_CONSUMER, WebSocketMessage
+from .serializer import dumps, loads, to_primitive
 from .model import UserSchema
+from .pubsub import PubSub, create_pubsub
 
 
-class ConnectionManager:
+logger = logging.getLogger(__name__)
+
+# message types that carry normalized devices and how to get them out
+DEVICE_MESSAGES = {
+    "light": lambda data: ("light", [data]),
+    "plug": lambda data: ("plug", [data]),
+    "lights": lambda data: ("light", data["lights"]),
+}
+
+
+# @brief Last state one subscribed connection has seen, with the sequence
+# number of the last patch it was sent.
+#
+# Clients that subscribe get one snapshot and from then on only the fields
+# that changed. Every patch bumps `seq` by one, so a client that sees a gap
+# knows it missed something and asks for a resync.
+#
+# While the snapshot is being read the feed is `loading`: device messages are
+# only recorded and win over the snapshot, as they were published after the
+# read started.
+class DeviceFeed:
     def __init__(self):
-        self.active_connections: dict[str, list[WebSocket]] = {}
+        self.seq = 0
+        self.loading = True
+        self.devices: dict[tuple[str, str], dict] = {}
 
-    def __get_user_from_token__(self, token: str) -> UserSchema | None:
-        decoded = decodeJWT(token)
-        if decoded is None or JWTBearer().verify_jwt(token) is False:
+    def load(self, devices: dict[str, list]):
+        for type, items in devices.items():
+            for device in items:
+                device = to_primitive(device)
+                self.devices.setdefault((type, device["id"]), device)
+        self.loading = False
+
+    def snapshot(self) -> dict:
+        data = {"lights": [], "plugs": []}
+        for (type, _), device in self.devices.items():
+            data[f"{type}s"].append(device)
+        return {"type": "snapshot", "seq": self.seq, "data": data}
+
+    # @brief Records the given device dicts and returns the patch message for
+    # them, or None if nothing changed.
+    def patch(self, type: str, devices: list[dict]) -> dict | None:
+        if self.loading:
+            for device in devices:
+                self.devices[(type, device["id"])] = device
             return None
-        db = SessionLocal()
-        user = crud.get_user_by_email(db, decoded["email"])
-        if user is None:
+        changes = []
+        for device in devices:
+            previous = self.devices.get((type, device["id"]))
+            self.devices[(type, device["id"])] = device
+            if previous is None:
+                changes.append(
+                    {"type": type, "id": device["id"], "changes": device})
+                continue
+            changed = {key: value for key, value in device.items()
+                       if previous.get(key) != value}
+            changed.update({key: None for key in previous if key not in device})
+            if len(changed) > 0:
+                changes.append(
+                    {"type": type, "id": device["id"], "changes": changed})
+        if len(changes) == 0:
+            return None
+        self.seq += 1
+        return {"type": "patch", "seq": self.seq, "data": changes}
+
+
+# @brief Type of a JSON command sent by a client, None for plain pings.
+def command_of(text: str) -> str | None:
+    if not text.startswith("{"):
+        return None
+    try:
+        message = loads(text)
+    except ValueError:
+        return None
+    return message.get("type") if isinstance(message, dict) else None
+
+
+# @brief One accepted websocket with its own bounded send queue.
+#
+# Messages are only queued by the senders and written by one writer task per
+# connection, so a stalled client never holds up anybody else or the request
+# that triggered the message. When the queue is full the `policy` decides:
+# drop_oldest drops the oldest queued message, coalesce first replaces a
+# queued message for the same device (falling back to drop_oldest) and
+# disconnect closes the connection.
+class Connection:
+    def __init__(self, websocket: WebSocket, user_id: int, email: str, on_close, size: int = WS_SEND_QUEUE,
+                 policy: str = WS_SLOW_CONSUMER, timeout: float = WS_SEND_TIMEOUT):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.email = email
+        self.feed: DeviceFeed | None = None
+        self.size = size
+        self.policy = policy
+        self.timeout = timeout
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.__on_close__ = on_close
+        self.__queue__: deque[tuple[object, str]] = deque()
+        self.__ready__ = asyncio.Event()
+        self.__task__ = asyncio.create_task(self.__write__())
+
+    @property
+    def depth(self) -> int:
+        return len(self.__queue__)
+
+    def send(self, text: str, key: object = None):
+        if self.closed:
+            return
+        if self.policy == "coalesce" and key is not None:
+            for index, (queued, _) in enumerate(self.__queue__):
+                if queued == key:
+                    self.__queue__[index] = (key, text)
+                    self.dropped += 1
+                    return
+        if len(self.__queue__) >= self.size:
+            if self.policy == "disconnect":
+                self.dropped += len(self.__queue__) + 1
+                self.close(code=1013)
+                return
+            self.__queue__.popleft()
+            self.dropped += 1
+        self.__queue__.append((key, text))
+        self.__ready__.set()
+
+    async def __write__(self):
+        while True:
+            await self.__ready__.wait()
+            self.__ready__.clear()
+            while len(self.__queue__) > 0:
+                _, text = self.__queue__.popleft()
+                try:
+                    await asyncio.wait_for(self.websocket.send_text(text), self.timeout)
+                except Exception as error:
+                    logger.info("Closing websocket after failed send: %s", error)
+                    self.close()
+                    return
+                self.sent += 1
+
+    # @brief Stops the writer and closes the socket in the background, unless
+    # it's already closed.
+    def close(self, code: int = 1000):
+        if self.closed:
+            return
+        self.closed = True
+        self.__queue__.clear()
+        self.__task__.cancel()
+        self.__on_close__(self)
+        asyncio.create_task(self.__close_socket__(code))
+
+    async def __close_socket__(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def metrics(self) -> dict:
+        return {"depth": self.depth, "sent": self.sent, "dropped": self.dropped}
+
+
+# @brief Registry of the open websockets, keyed by user id.
+#
+# The user is looked up once when a socket is accepted and kept on its
+# Connection, so disconnects and sends are dict/set operations without any
+# database work.
+#
+# Sends and broadcasts are published once on the pub/sub `bus`; every worker
+# subscribed to it delivers them to the sockets it holds itself.
+class ConnectionManager:
+    def __init__(self, bus: PubSub):
+        self.bus = bus
+        self.active_connections: dict[int, set[Connection]] = {}
+        self.__connections__: dict[WebSocket, Connection] = {}
+        self.__emails__: dict[str, int] = {}
+
+    async def __get_user_from_token__(self, token: str) -> UserSchema | None:
+        decoded = decodeJWT(token)
+        if decoded is None or await jwt_bearer.verify_jwt(token) is False:
             return None
-        db.close()
-        return user
+        async with AsyncReadSessionLocal() as db:
+            return await async_crud.get_user_by_email(db, decoded["email"])
 
-    async def connect(self, websocket: WebSocket, token: str):
-        user = self.__get_user_from_token__(token)
+    async def connect(self, websocket: WebSocket, token: str) -> bool:
+        user = await self.__get_user_from_token__(token)
         if user is None:
             await websocket.close()
-            return
-        if self.active_connections.get(user.username) is None:
-            self.active_connections[user.username] = []
-        self.active_connections[user.username].append(websocket)
+            return False
         await websocket.accept()
+        connection = Connection(
+            websocket, user.id, user.email, self.__remove__)
+        self.active_connections.setdefault(user.id, set()).add(connection)
+        self.__connections__[websocket] = connection
+        self.__emails__[user.email] = user.id
+        return True
+
+    def __remove__(self, connection: Connection):
+        self.__connections__.pop(connection.websocket, None)
+        connections = self.active_connections.get(connection.user_id)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if len(connections) == 0:
+            del self.active_connections[connection.user_id]
+            self.__emails__.pop(connection.email, None)
+
+    async def start(self):
+        await self.bus.start(self.__deliver__)
+
+    async def stop(self):
+        await self.bus.stop()
 
-    def disconnect(self, websocket: WebSocket, token: str):
-        user = self.__get_user_from_token__(token)
-        if user is None or self.active_connections.get(user.username) is None:
+    def disconnect(self, websocket: WebSocket):
+        connection = self.__connections__.get(websocket)
+        if connection is not None:
+            connection.close()
+
+    # @brief Switches a connection to the patch protocol and sends it a
+    # snapshot of the devices returned by `read` ({"light": [...], "plug": [...]}).
+    #
+    # Every subscribe or resync starts a new feed for this connection only, so
+    # the other connections of the user keep their own baseline.
+    async def subscribe(self, websocket: WebSocket, read: Callable[[], Awaitable[dict[str, list]]]):
+        connection = self.__connections__.get(websocket)
+        if connection is None:
+            return
+        feed = DeviceFeed()
+        connection.feed = feed
+        try:
+            devices = await read()
+        except BaseException:
+            if connection.feed is feed:
+                connection.feed = None
+            raise
+        if connection.feed is not feed:
             return
-        self.active_connections[user.username].remove(websocket)
+        feed.load(devices)
+        connection.send(dumps(feed.snapshot()).decode())
 
     async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str, token: str):
-        user = self.__get_user_from_token__(token)
-        for username in self.active_connections:
-            if user is not None and username == user.username:
-                for connection in self.active_connections[username]:
-                    await connection.send_text(message)
+        connection = self.__connections__.get(websocket)
+        if connection is not None:
+            connection.send(message)
+
+    def metrics(self) -> dict:
+        connections = list(self.__connections__.values())
+        return {
+            "connections": len(connections),
+            "policy": WS_SLOW_CONSUMER,
+            "queue_size": WS_SEND_QUEUE,
+            "depth": sum(connection.depth for connection in connections),
+            "sent": sum(connection.sent for connection in connections),
+            "dropped": sum(connection.dropped for connection in connections),
+            "queues": [connection.metrics() for connection in connections],
+        }
+
+    # @brief Sends a {"type", "data"} message to all connections of a user.
+    #
+    # Plain clients share one encoding of the full message. Subscribed
+    # clients get a patch against their own feed, or nothing when a device
+    # message changes nothing they have seen.
+    def __send_to_user__(self, user_id: int, message: dict):
+        connections = self.active_connections.get(user_id)
+        if connections is None:
+            return
+        full = None
+        patchable = False
+        extract = DEVICE_MESSAGES.get(message["type"])
+        if extract is not None and any(connection.feed is not None for connection in connections):
+            type, devices = extract(message["data"])
+            devices = [to_primitive(device) for device in devices]
+            # raw bridge payloads have no normalized id and are sent as they are
+            patchable = all(isinstance(device, dict) and "id" in device
+                            for device in devices)
+        # queued full messages of the same device may be coalesced
+        key = None
+        if message["type"] in ("light", "plug") and isinstance(message["data"], dict) \
+                and message["data"].get("id") is not None:
+            key = (message["type"], message["data"]["id"])
+        for connection in list(connections):
+            if patchable and connection.feed is not None:
+                patch = connection.feed.patch(type, devices)
+                if patch is not None:
+                    connection.send(dumps(patch).decode())
+                continue
+            if full is None:
+                full = dumps(message).decode()
+            connection.send(full, key)
+
+    def __broadcast__(self, email: str, message: dict):
+        owner = self.__emails__.get(email)
+        empty = None
+        for user_id in list(self.active_connections):
+            if user_id == owner:
+                self.__send_to_user__(user_id, message)
             else:
-                for connection in self.active_connections[username]:
-                    await connection.send_text(dumps({
-                        "type": loads(message)["type"],
-                        "data": None
-                    }))
+                if empty is None:
+                    empty = dumps({"type": message["type"], "data": None}).decode()
+                for connection in list(self.active_connections.get(user_id) or ()):
+                    connection.send(empty, (message["type"], None))
+
+    # @brief Delivers a bus message to the sockets of this worker.
+    def __deliver__(self, message: dict):
+        try:
+            if message["kind"] == "user":
+                self.__send_to_user__(message["user_id"], message["message"])
+            elif message["kind"] == "broadcast":
+                self.__broadcast__(message["email"], message["message"])
+        except Exception:
+            logger.exception("Delivering a websocket message failed")
+
+    async def send_to_user(self, user_id: int, message: dict):
+        await self.bus.publish({"kind": "user", "user_id": user_id, "message": message})
+
+    async def broadcast(self, message: WebSocketMessage, token: str):
+        decoded = decodeJWT(token)
+        if decoded is None:
+            return
+        await self.bus.publish({
+            "kind": "broadcast",
+            "email": decoded["email"],
+            "message": {"type": message.type, "data": message.data},
+        })
 
 
-manager = ConnectionManager()
+manager = ConnectionManager(create_pubsub())
 
 
 async def broadcast(message: WebSocketMessage, token: str):
-    await manager.broadcast(dumps(message.__dict__), token)
+    await manager.broadcast(message, token)
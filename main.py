@@ -1,10 +1,27 @@
 #!/usr/bin/env python3
 
 if __name__ == "__main__":
+    import os
     import uvicorn
-    from app import app, consts
+    from app import consts
     from app.sql_app.database import Base, engine
-    
+
+    # the schema is prepared once here, before any worker is started
+    if consts.DATABASE_MIGRATE:
+        from alembic import command
+        from alembic.config import Config
+        command.upgrade(Config(os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "alembic.ini")), "head")
     Base.metadata.create_all(bind=engine)
+    engine.dispose()
 
-    uvicorn.run(app, host="0.0.0.0", port=consts.port)
+    if consts.WORKERS > 1:
+        # workers need a shared bus to reach each other's websockets
+        if consts.PUBSUB_URL.startswith("memory:"):
+            os.environ["PUBSUB_URL"] = "unix://" + \
+                os.path.abspath(consts.PUBSUB_SOCKET)
+        uvicorn.run("app:app", host="0.0.0.0",
+                    port=consts.port, workers=consts.WORKERS)
+    else:
+        from app import app
+        uvicorn.run(app, host="0.0.0.0", port=consts.port)